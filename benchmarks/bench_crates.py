@@ -0,0 +1,232 @@
+# Crate throughput and open-to-delivery latency, run against small synthetic
+# episodes made with ffmpeg's lavfi test sources. Discord and MongoDB are
+# replaced with in-memory stand-ins so only crate generation is measured.
+# Each crate kind runs in a process of its own so peak RSS is per kind.
+#
+#   python -m benchmarks.bench_crates [crates] [episodes] [seconds]
+
+import asyncio
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from collections import OrderedDict
+
+from spongebot.catalog import Episode
+from spongebot.cratemanager import CrateManager
+from spongebot.ffmpeg import FFmpegRunner
+from spongebot.session import SessionRegistry
+
+
+def make_episodes(directory, count, seconds):
+    for i in range(count):
+        path = os.path.join(directory, 'S01E%02d.avi' % (i + 1))
+        # A keyframe every two seconds, like a typical rip.
+        subprocess.check_call(['ffmpeg', '-v', 'error', '-y',
+                               '-f', 'lavfi', '-i', 'testsrc=size=640x480:rate=24:duration=%d' % seconds,
+                               '-f', 'lavfi', '-i', 'sine=frequency=%d:duration=%d' % (220 + 110 * i, seconds),
+                               '-c:v', 'mpeg4', '-q:v', '5', '-g', '48', '-c:a', 'pcm_s16le', path])
+
+
+def load_episodes(directory, seconds):
+    episodes = []
+    for i, name in enumerate(sorted(os.listdir(directory))):
+        path = os.path.join(directory, name)
+        stat = os.stat(path)
+        episode = Episode(name, 1, i + 1, 'Synthetic %d' % (i + 1), path, stat.st_size, int(stat.st_mtime))
+        episode.duration = seconds
+        episodes.append(episode)
+    return episodes
+
+
+class LocalUserStore:
+    # The parts of UserMongoDB the crate pipeline uses, kept in a dict.
+    def __init__(self):
+        self.users = {}
+        self.items = 0
+
+    def document(self, user):
+        user_id = getattr(user, 'id', user)
+        return self.users.setdefault(user_id, {'current_points': 10 ** 9, 'crates_opened': 0,
+                                               'frame_id': 0, 'voiceline_id': 0})
+
+    async def get(self, user, fields=None):
+        return types.SimpleNamespace(**self.document(user))
+
+    async def charge(self, user, price, increments, fields):
+        document = self.document(user)
+        if document['current_points'] < price:
+            return None
+        document['current_points'] -= price
+        for field, amount in increments.items():
+            document[field] += amount
+        return types.SimpleNamespace(**document)
+
+    async def update(self, user, new):
+        document = self.document(user)
+        for field, amount in new.get('$inc', {}).items():
+            document[field] += amount
+        return True
+
+    async def add_item(self, user, item):
+        self.items += 1
+        return True
+
+
+class StubBot:
+    # Stands in for Spongebot: config, logging, the ffmpeg runner and the
+    # Discord calls crates make.
+    def __init__(self, loop, episodes):
+        self.loop = loop
+        self.config = {'crate_queue_size': 10 ** 6, 'crate_user_limit': 10 ** 6, 'frame_pool_size': 0}
+        self.is_closed = False
+        self.episode_data = episodes
+        self.sessions = SessionRegistry(self)
+        self.userdb = LocalUserStore()
+        self.ffmpeg = FFmpegRunner(self)
+        self.crate_manager = None
+
+        self.failures = 0
+        self.uploaded = 0
+
+    def log(self, msg, level=logging.DEBUG):
+        pass
+
+    async def send_message(self, destination, content=None, embed=None):
+        if content and 'Something went wrong' in content:
+            self.failures += 1
+
+    async def send_file(self, destination, fp, filename=None, content=None):
+        self.uploaded += len(fp.read())
+
+
+class FixedRoll:
+    # Replaces the crate manager's Random so every crate is the same type.
+    def __init__(self, roll):
+        self.roll = roll
+
+    def seed(self, *args):
+        pass
+
+    def random(self):
+        return self.roll
+
+
+# Rolls under .33 make voiceline crates.
+ROLLS = OrderedDict([('frame', 0.9), ('voiceline', 0.1)])
+
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+async def run(bot, crates, roll):
+    manager = bot.crate_manager = CrateManager(bot)
+    manager.rng = FixedRoll(roll)
+
+    opened = {}
+    latencies = []
+
+    deliver_crate = manager.deliver_crate
+
+    async def timed_delivery(crate):
+        await deliver_crate(crate)
+        latencies.append(time.perf_counter() - opened[crate.user_id])
+
+    manager.deliver_crate = timed_delivery
+    manager.initialize_tasks()
+
+    start = time.perf_counter()
+    for i in range(crates):
+        # One user per crate, so the per-user limit never applies.
+        user_id = 'user%d' % i
+        author = types.SimpleNamespace(id=user_id)
+        opened[user_id] = time.perf_counter()
+        await manager.generate_crate(types.SimpleNamespace(author=author, channel=None))
+
+    # Refunded crates never reach delivery, so poll for both.
+    while len(latencies) + bot.failures < crates:
+        await asyncio.sleep(0.01, loop=bot.loop)
+    return time.perf_counter() - start, latencies
+
+
+def measure(kind, crates, seconds):
+    # Runs in its own process per crate kind (see main), so the peak RSS
+    # figures cover only that kind.
+    roll = ROLLS[kind]
+    for directory in ('frames', 'voicelines'):
+        shutil.rmtree(directory, ignore_errors=True)
+        os.mkdir(directory)
+
+    loop = asyncio.get_event_loop()
+    bot = StubBot(loop, load_episodes('content', seconds))
+    elapsed, latencies = loop.run_until_complete(run(bot, crates, roll))
+
+    # Let every ffmpeg finish and reap the pydub workers before reading
+    # RUSAGE_CHILDREN, which only counts children that have been waited for.
+    while bot.ffmpeg.processes:
+        loop.run_until_complete(asyncio.sleep(0.01, loop=loop))
+    bot.ffmpeg.close()
+    if bot.crate_manager.process_executor is not None:
+        bot.crate_manager.process_executor.shutdown(wait=True)
+
+    disk = sum(directory_size(directory) for directory in os.listdir('.') if directory != 'content')
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    print('\n%s crates: %d delivered, %d failed in %.2fs' % (kind, len(latencies), bot.failures, elapsed))
+    print('  throughput:  %.2f crates/s' % (len(latencies) / elapsed))
+    if latencies:
+        print('  latency:     p50 %.0f ms, p99 %.0f ms' % (percentile(latencies, 50) * 1000,
+                                                       percentile(latencies, 99) * 1000))
+    print('  peak RSS:    %.1f MiB bot, %.1f MiB largest child' % (self_rss / 1024.0, child_rss / 1024.0))
+    print('  temp disk:   %.1f MiB' % (disk / 1024.0 / 1024.0))
+    print('  uploaded:    %.1f KiB' % (bot.uploaded / 1024.0))
+    print('  ffmpeg runs: %d (%d failed)' % (bot.ffmpeg.runs, bot.ffmpeg.failures))
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--kind':
+        # Started by main below, from the work directory.
+        measure(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+        return
+
+    crates = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    episode_count = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    seconds = int(sys.argv[3]) if len(sys.argv) > 3 else 120
+
+    workdir = tempfile.mkdtemp(prefix='spongebot-bench-')
+    try:
+        os.mkdir(os.path.join(workdir, 'content'))
+
+        start = time.perf_counter()
+        make_episodes(os.path.join(workdir, 'content'), episode_count, seconds)
+        print('%d synthetic episodes of %ds made in %.1fs' % (episode_count, seconds, time.perf_counter() - start))
+        sys.stdout.flush()
+
+        # The package has to stay importable from the work directory.
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.getcwd(), env.get('PYTHONPATH')]))
+        for kind in ROLLS:
+            subprocess.check_call([sys.executable, '-m', 'benchmarks.bench_crates', '--kind', kind,
+                                   str(crates), str(seconds)], cwd=workdir, env=env)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
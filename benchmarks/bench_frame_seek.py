@@ -0,0 +1,83 @@
+# Frame extraction time against timestamp position: decoding from the start
+# of the file (output seeking), plain input seeking, and seeking to the
+# preceding keyframe from the index. The index costs one packet scan of the
+# whole file, printed first, which keyframe seeking has to win back.
+#
+#   python -m benchmarks.bench_frame_seek <episode> [positions] [rounds]
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from spongebot.keyframes import KeyframeIndex
+
+
+def probe_duration(path):
+    output = subprocess.check_output(['ffprobe', '-v', 'error', '-show_entries', 'format=duration',
+                                      '-of', 'csv=print_section=0', path])
+    return float(output.strip())
+
+
+def probe_keyframes(path):
+    return KeyframeIndex.parse(subprocess.check_output(['ffprobe'] + KeyframeIndex.PROBE_ARGUMENTS + [path]))
+
+
+def output_seek(path, t, outpath):
+    return ['ffmpeg', '-v', 'error', '-y', '-i', path, '-vcodec', 'png', '-ss', '%.3f' % t, '-s', '320x240',
+            '-vframes', '1', '-an', '-f', 'rawvideo', outpath]
+
+
+def input_seek(path, t, outpath):
+    # What extraction falls back to without an index.
+    return ['ffmpeg', '-v', 'error', '-y', '-ss', '%.3f' % t, '-i', path, '-vcodec', 'png', '-s', '320x240',
+            '-vframes', '1', '-an', '-f', 'rawvideo', outpath]
+
+
+def keyframe_seek(path, t, outpath, keyframes):
+    seek = KeyframeIndex.before(keyframes, t)
+    return ['ffmpeg', '-v', 'error', '-y', '-ss', '%.3f' % seek, '-i', path, '-ss', '%.3f' % (t - seek),
+            '-vcodec', 'png', '-s', '320x240', '-vframes', '1', '-an', '-f', 'rawvideo', outpath]
+
+
+def timed(command, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        subprocess.check_call(command)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    if len(sys.argv) < 2:
+        print('usage: python -m benchmarks.bench_frame_seek <episode> [positions] [rounds]')
+        sys.exit(1)
+
+    path = sys.argv[1]
+    positions = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+
+    duration = probe_duration(path)
+
+    start = time.perf_counter()
+    keyframes = probe_keyframes(path)
+    print('%d keyframes indexed in %.0f ms' % (len(keyframes), (time.perf_counter() - start) * 1000))
+
+    outpath = os.path.join(tempfile.mkdtemp(), 'frame.png')
+    print('%10s %14s %14s %14s %8s' % ('position', 'output seek', 'input seek', 'keyframe seek', 'speedup'))
+    for i in range(positions):
+        t = duration * (i + 0.5) / positions
+        output = timed(output_seek(path, t, outpath), rounds)
+        plain = timed(input_seek(path, t, outpath), rounds)
+        indexed = timed(keyframe_seek(path, t, outpath, keyframes), rounds)
+        # Speedup is over plain input seeking, the fallback without an index.
+        print('%9.1fs %11.1f ms %11.1f ms %11.1f ms %7.1fx' % (t, output * 1000, plain * 1000, indexed * 1000,
+                                                               plain / indexed))
+    os.remove(outpath)
+
+
+if __name__ == '__main__':
+    main()
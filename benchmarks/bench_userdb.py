@@ -0,0 +1,72 @@
+# Encode/decode cost and memory of a SpongebotUser with a large inventory.
+#
+#   python -m benchmarks.bench_userdb [items] [rounds]
+
+import copy
+import sys
+import time
+import tracemalloc
+
+from spongebot.userdb import SpongebotUser
+
+
+def make_document(items):
+    inventory = []
+    for i in range(items):
+        item_type = 'voiceline' if i % 3 == 0 else 'frame'
+        directory = 'voicelines' if item_type == 'voiceline' else 'frames'
+        inventory.append({
+            'item_type': item_type,
+            'date_received': 1500000000 + i,
+            'name': str(i),
+            'idx': i,
+            'from_episode': '%s/123456789/%d' % (directory, i),
+        })
+
+    return {
+        '_id': '123456789',
+        'name': 'spongebob',
+        'create_date': 1500000000,
+        'access_level': 0,
+        'current_points': 15,
+        'total_points': 20 * items,
+        'crates_opened': items,
+        'frame_id': items,
+        'voiceline_id': items // 3,
+        'episodes_watched': 120,
+        'episode_list': ['episode %d' % i for i in range(120)],
+        'inventory': inventory,
+        'last_sold_item': None,
+    }
+
+
+def main():
+    items = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    documents = [copy.deepcopy(make_document(items)) for _ in range(rounds)]
+
+    start = time.perf_counter()
+    users = [SpongebotUser.from_document(document) for document in documents]
+    decode = (time.perf_counter() - start) / rounds
+
+    start = time.perf_counter()
+    for user in users:
+        user.as_document()
+    encode = (time.perf_counter() - start) / rounds
+
+    document = make_document(items)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    user = SpongebotUser.from_document(document)
+    memory = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    print('%d items, %d rounds' % (items, rounds))
+    print('decode: %.3f ms/user' % (decode * 1000))
+    print('encode: %.3f ms/user' % (encode * 1000))
+    print('memory: %.1f KiB/user' % (memory / 1024))
+
+
+if __name__ == '__main__':
+    main()
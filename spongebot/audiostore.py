@@ -0,0 +1,141 @@
+import array
+import asyncio
+import mmap
+import os
+import sys
+import wave
+
+
+class AudioStore:
+    # Each episode's audio track is decoded once into raw PCM on disk, then
+    # voicelines are cut straight out of an mmap of that file, with no ffmpeg
+    # process and no decoded copy of the episode in memory.
+    SAMPLE_WIDTH = 2  # s16le
+
+    def __init__(self, bot):
+        self.bot = bot
+
+        self.build_locks = {}
+
+    @property
+    def enabled(self):
+        return self.bot.config.get('audio_store', False)
+
+    @property
+    def directory(self):
+        return self.bot.config.get('audio_store_directory', 'audiostore')
+
+    @property
+    def rate(self):
+        return self.bot.config.get('audio_store_rate', 24000)
+
+    @property
+    def channels(self):
+        return self.bot.config.get('audio_store_channels', 1)
+
+    @property
+    def budget(self):
+        return self.bot.config.get('audio_store_budget_mb', 2048) * 1024 * 1024
+
+    def path_for(self, episode):
+        # A replaced episode file gets a new entry and the old one ages out
+        # through eviction.
+        return os.path.join(self.directory, episode.cache_key(self.rate, self.channels) + '.pcm')
+
+    async def ensure(self, episode):
+        path = self.path_for(episode)
+
+        # Two crates from the same episode wait for one build.
+        build_lock = self.build_locks.setdefault(path, asyncio.Lock(loop=self.bot.loop))
+        async with build_lock:
+            if os.path.isfile(path):
+                # Marks it as recently used for eviction.
+                os.utime(path)
+            else:
+                await self.build(episode, path)
+
+        return path
+
+    async def build(self, episode, path):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        expected = int(episode.length * self.rate) * self.channels * self.SAMPLE_WIDTH
+        await self.bot.loop.run_in_executor(None, self.evict, expected)
+
+        self.bot.log('Decoding audio of %s into the audio store...' % episode)
+
+        partial = path + '.tmp'
+        try:
+            await self.bot.ffmpeg.run(['-v', 'error', '-y', '-i', episode.path, '-vn',
+                                       '-ac', str(self.channels), '-ar', str(self.rate), '-f', 's16le', partial],
+                                      timeout=self.bot.config.get('audio_store_timeout', 600))
+            os.replace(partial, path)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+
+    def evict(self, needed):
+        # Drops the least recently used episodes until the new one fits.
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith('.pcm'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        entries.sort()
+        while entries and total + needed > self.budget:
+            mtime, size, path = entries.pop(0)
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.bot.log('Evicted %s from the audio store.' % path)
+
+    async def clip(self, episode, start, duration, outpath, fade=0.25):
+        # Writes duration seconds from start to a WAV file, fading out over the
+        # last `fade` seconds. Returns the length written in seconds.
+        path = await self.ensure(episode)
+        return await self.bot.loop.run_in_executor(None, self.slice, path, start, duration, outpath, fade)
+
+    def slice(self, path, start, duration, outpath, fade):
+        frame_size = self.channels * self.SAMPLE_WIDTH
+
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                view = memoryview(mm)
+                begin = min(len(mm), int(start * self.rate) * frame_size)
+                end = min(len(mm), begin + int(duration * self.rate) * frame_size)
+                fade_begin = max(begin, end - int(fade * self.rate) * frame_size)
+
+                # Only the faded tail is copied; the rest goes straight from
+                # the mapping to the file.
+                tail = array.array('h')
+                tail.frombytes(view[fade_begin:end])
+                if sys.byteorder == 'big':
+                    tail.byteswap()
+                frames = max(1, len(tail) // self.channels)
+                for i in range(len(tail)):
+                    tail[i] = int(tail[i] * (1 - (i // self.channels) / frames))
+                if sys.byteorder == 'big':
+                    tail.byteswap()
+
+                out = wave.open(outpath, 'wb')
+                try:
+                    out.setnchannels(self.channels)
+                    out.setsampwidth(self.SAMPLE_WIDTH)
+                    out.setframerate(self.rate)
+                    out.writeframes(view[begin:fade_begin])
+                    out.writeframes(tail.tobytes())
+                finally:
+                    out.close()
+
+                view.release()
+            finally:
+                mm.close()
+
+        return (end - begin) / frame_size / self.rate
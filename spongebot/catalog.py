@@ -0,0 +1,217 @@
+import hashlib
+import json
+import os
+import subprocess
+
+
+class Episode:
+    # Used for episodes that couldn't be probed.
+    DEFAULT_DURATION = 11 * 60
+
+    def __init__(self, filename, season, episode, name, path, size=0, mtime=0):
+        self.filename = filename
+        self.season = season
+        self.episode = episode
+        self.name = name
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        # Filled in by ffprobe; None until the episode has been probed.
+        self.duration = None
+        self.streams = []
+
+    @property
+    def length(self):
+        return self.duration or self.DEFAULT_DURATION
+
+    def first_stream(self, codec_type):
+        for stream in self.streams:
+            if stream.get('codec_type') == codec_type:
+                return stream
+        return None
+
+    def cache_key(self, *extra):
+        # Names files derived from this episode. Size and mtime are part of
+        # it, so a replaced episode file never reuses what the old one left.
+        key = '|'.join(str(value) for value in (self.path, self.size, self.mtime) + extra)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def as_document(self):
+        return {
+            'filename': self.filename,
+            'season': self.season,
+            'episode': self.episode,
+            'name': self.name,
+            'path': self.path,
+            'size': self.size,
+            'mtime': self.mtime,
+            'duration': self.duration,
+            'streams': self.streams,
+        }
+
+    @classmethod
+    def from_document(cls, document):
+        episode = cls(document['filename'], document['season'], document['episode'], document['name'],
+                      document['path'], document.get('size', 0), document.get('mtime', 0))
+        episode.duration = document.get('duration')
+        episode.streams = document.get('streams', [])
+        return episode
+
+    def __str__(self):
+        return self.name
+
+
+class EpisodeCatalog:
+    # Episodes found in the content directory, cached in a manifest so a
+    # restart doesn't have to walk and parse the whole library again.
+    VERSION = 1
+
+    def __init__(self, bot):
+        self.bot = bot
+
+        self.directories = {}  # directory -> {'mtime': ..., 'subdirs': [...], 'files': [...]}
+        self.episodes = {}  # path -> Episode
+
+    @property
+    def manifest_path(self):
+        return self.bot.config.get('catalog_path', 'catalog.json')
+
+    @property
+    def content_directory(self):
+        return self.bot.config.get('content_directory', 'content')
+
+    @property
+    def content_extension(self):
+        return self.bot.config.get('content_extension', 'avi')
+
+    def load(self):
+        try:
+            with open(self.manifest_path, 'r') as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            return False
+
+        if manifest.get('version') != self.VERSION or \
+                manifest.get('content_directory') != self.content_directory or \
+                manifest.get('content_extension') != self.content_extension:
+            self.bot.log('Episode catalog is out of date, ignoring it.')
+            return False
+
+        self.directories = manifest['directories']
+        self.episodes = {path: Episode.from_document(document) for path, document in manifest['episodes'].items()}
+        self.bot.log('Loaded %d episode(s) from the catalog.' % len(self.episodes))
+        return True
+
+    def save(self):
+        manifest = {
+            'version': self.VERSION,
+            'content_directory': self.content_directory,
+            'content_extension': self.content_extension,
+            'directories': self.directories,
+            'episodes': {path: episode.as_document() for path, episode in self.episodes.items()},
+        }
+
+        path = self.manifest_path + '.tmp'
+        with open(path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(path, self.manifest_path)
+
+    def refresh(self):
+        # Only directories whose mtime changed are listed again, and only files
+        # whose size or mtime changed are parsed again. Returns the number of
+        # episodes added and removed.
+        directories = {}
+        episodes = {}
+        self.scan_directory(self.content_directory, directories, episodes)
+
+        added = [path for path in episodes if path not in self.episodes]
+        removed = [path for path in self.episodes if path not in episodes]
+        for path in added:
+            self.bot.log('Found episode %s' % episodes[path])
+        for path in removed:
+            self.bot.log('Episode %s is gone' % self.episodes[path])
+
+        self.directories = directories
+        self.episodes = episodes
+        self.save()
+
+        return len(added), len(removed)
+
+    def scan_directory(self, directory, directories, episodes):
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            return
+
+        known = self.directories.get(directory)
+        if known is not None and known['mtime'] == mtime:
+            # Same entries as last time; just check the files we know about.
+            subdirs = known['subdirs']
+            files = known['files']
+        else:
+            subdirs = []
+            files = []
+            for entry in os.scandir(directory):
+                if entry.is_dir():
+                    subdirs.append(entry.path)
+                elif entry.is_file():
+                    files.append(entry.path)
+
+        directories[directory] = {'mtime': mtime, 'subdirs': subdirs, 'files': files}
+
+        for path in files:
+            episode = self.scan_file(path)
+            if episode is not None:
+                episodes[path] = episode
+
+        for subdir in subdirs:
+            self.scan_directory(subdir, directories, episodes)
+
+    def scan_file(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        episode = self.episodes.get(path)
+        if episode is not None and episode.size == stat.st_size and episode.mtime == stat.st_mtime:
+            if episode.duration is None:
+                self.probe(episode)
+            return episode
+
+        filename, extension = os.path.splitext(os.path.basename(path))
+        filename = filename.lower()
+
+        if extension[1:] != self.content_extension:
+            return None
+
+        try:
+            episode_number, episode_name = filename.split(' ', 1)
+            season, episode = int(episode_number[0]), int(episode_number[1:])
+        except ValueError:
+            self.bot.log('Skipping badly named episode %s' % path)
+            return None
+
+        episode = Episode(filename, season, episode, episode_name, path, stat.st_size, stat.st_mtime)
+        self.probe(episode)
+        return episode
+
+    def probe(self, episode):
+        # Reads the container header only; nothing gets decoded.
+        command = [self.bot.config.get('ffprobe_path', 'ffprobe'), '-v', 'error', '-of', 'json',
+                   '-show_entries', 'format=duration:stream=index,codec_type,codec_name,sample_rate,channels,'
+                                    'width,height,avg_frame_rate',
+                   episode.path]
+        try:
+            output = subprocess.check_output(command, stdin=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            info = json.loads(output.decode('utf-8'))
+            episode.duration = float(info['format']['duration'])
+            episode.streams = info.get('streams', [])
+        except (OSError, subprocess.CalledProcessError, ValueError, KeyError) as e:
+            self.bot.log('Failed to probe episode %s: %s' % (episode.path, e))
+            # Don't retry on every refresh; fall back to the default length.
+            episode.duration = 0
+            episode.streams = []
+
+    def episode_list(self):
+        return sorted(self.episodes.values(), key=lambda e: (e.season, e.episode, e.path))
@@ -1,11 +1,11 @@
-import random
 import datetime
 import os
 import re
 
 from discord.embeds import Embed
-from spongebot.constants import RANKS
+from spongebot.constants import rank_title
 from spongebot.botrequest import SellRequest, BotRequestException
+from spongebot.ratelimit import RateLimiter
 
 
 # Context
@@ -20,82 +20,121 @@ VIP = 100
 ADMIN = 200
 
 
-# longest decorator ever!!!!
-def command(context, access, types=tuple()):
+def command(context, access, types=tuple(), optional=tuple(), aliases=tuple()):
+    # Only records how the command may be used; CommandManager builds its
+    # registry from these and checks them in dispatch.
     def real_decorator(func):
-        def wrapper(*args, **kwargs):
-            command_manager = args[0]
-            source = args[1]
-            command_name = args[2]
-            current_access = args[3]
-
-            if context == PRIVATE:
-                if not source.channel.is_private:
-                    return command_manager.invalid_context(source, command_name, context)
-            elif context == PUBLIC:
-                if source.channel.is_private:
-                    return command_manager.invalid_context(source, command_name, context)
-
-            if access > current_access:
-                return command_manager.invalid_access(source, command_name, access)
-
-            nargs = [command_manager, source]
-
-            command_args = args[4:]
-
-            if len(command_args) != len(types):
-                return command_manager.invalid_arguments(source, command_name)
-
-            for i in range(len(types)):
-                t = types[i]
-                arg = command_args[i]
-
-                if t == int:
-                    try:
-                        arg = int(arg)
-                    except ValueError:
-                        return command_manager.invalid_arguments(source, command_name)
-                    else:
-                        nargs.append(arg)
-                elif t == float:
-                    try:
-                        arg = float(arg)
-                    except ValueError:
-                        return command_manager.invalid_arguments(source, command_name)
-                    else:
-                        nargs.append(arg)
-                else:
-                    nargs.append(arg)
-
-            return func(*nargs, **kwargs)
-
-        wrapper.__doc__ = func.__doc__
-        return wrapper
+        func.command = {'context': context, 'access': access, 'types': types, 'optional': optional,
+                        'aliases': aliases}
+        return func
     return real_decorator
 
 
+class Command:
+    def __init__(self, name, handler, context, access, types, optional, aliases):
+        self.name = name
+        self.handler = handler
+        self.context = context
+        self.access = access
+        self.types = types
+        self.optional = optional
+        self.aliases = aliases
+        self.help = handler.__doc__
+
+    def parse_arguments(self, args):
+        # Converts the arguments to the declared types, or returns None if
+        # they don't fit.
+        if not len(self.types) <= len(args) <= len(self.types) + len(self.optional):
+            return None
+
+        parsed = []
+        for t, arg in zip(self.types + self.optional, args):
+            if t == int or t == float:
+                try:
+                    arg = t(arg)
+                except ValueError:
+                    return None
+            parsed.append(arg)
+        return parsed
+
+
 class CommandManager:
     def __init__(self, bot):
         self.bot = bot
 
-    @command(context=PUBLIC, access=USER)
-    async def c_help(self, source):
-        output = '* - Direct Message only\n\n'
-        commands = [command for command in dir(self) if command.startswith('c_')]
-        commands.sort()
-        for command in commands:
-            name = command[2:]
-            if name == 'help':
+        # Lower-cased name or alias -> Command
+        self.commands = {}
+        for attribute in sorted(dir(type(self))):
+            handler = getattr(type(self), attribute)
+            if not attribute.startswith('c_') or not hasattr(handler, 'command'):
                 continue
 
-            documentation = getattr(self, command).__doc__
-            if documentation == None:
+            command = Command(attribute[2:], handler, **handler.command)
+            for name in (command.name,) + command.aliases:
+                self.commands[name.lower()] = command
+
+        self.help_embed = None
+        self.rate_limiter = RateLimiter(bot)
+
+    def lookup(self, name):
+        return self.commands.get(name.lower())
+
+    async def dispatch(self, source, command_name, args):
+        # Everything that can be checked without the database is checked
+        # before the user is looked up.
+        command = self.lookup(command_name)
+
+        # Unknown commands share one set of buckets.
+        allowed, notice = self.rate_limiter.check(
+            command.name if command is not None else 'default', source.author.id, source.channel.id)
+        if not allowed:
+            if notice is not None:
+                await self.bot.send_message(source.channel, notice)
+            return
+
+        if command is None:
+            await self.bot.send_message(source.channel, 'Unknown command ```%s```' % command_name)
+            return
+
+        if command.context == PRIVATE and not source.channel.is_private or \
+                command.context == PUBLIC and source.channel.is_private:
+            await self.invalid_context(source, command_name, command.context)
+            return
+
+        parsed = command.parse_arguments(args)
+        if parsed is None:
+            await self.invalid_arguments(source, command_name)
+            return
+
+        access = await self.bot.userdb.bootstrap(source.author)
+        if command.access > access:
+            await self.invalid_access(source, command_name, command.access)
+            return
+
+        await command.handler(self, source, *parsed)
+
+    def render_help(self):
+        output = '* - Direct Message only\n\n'
+        delimeter = self.bot.config.get('command_delimeter', '$')
+
+        for command in sorted(set(self.commands.values()), key=lambda command: command.name):
+            if command.name == 'help' or command.help is None:
                 continue
 
-            output += '%s: %s\n' % (self.bot.config.get('command_delimeter', '$') + name, documentation)
+            name = delimeter + command.name
+            if command.aliases:
+                name += ' (%s)' % ', '.join(delimeter + alias for alias in command.aliases)
+
+            output += '%s: %s\n' % (name, command.help)
 
-        embed = Embed(title='Commands', description='```%s```' % output, colour=0x7EC0EE)
-        await self.bot.send_message(source.channel, None, embed=embed)
+        return Embed(title='Commands', description='```%s```' % output, colour=0x7EC0EE)
+
+    @command(context=PUBLIC, access=USER)
+    async def c_help(self, source):
+        # Built on first use, once the config is loaded.
+        if self.help_embed is None:
+            self.help_embed = self.render_help()
+        await self.bot.send_message(source.channel, None, embed=self.help_embed)
 
     @command(context=PUBLIC, access=USER)
     async def c_join(self, source):
@@ -115,16 +154,16 @@ class CommandManager:
         else:
             await self.bot.send_message(source.channel, '```I am already in the channel!```')
 
+        session = self.bot.sessions.get(channel.server)
+
         def after():
             import datetime
             now = datetime.datetime.now()
             night_hours = (20, 21, 22, 23, 24, 1, 2, 3, 4, 5)  # 8pm to 5am
             if now.hour in night_hours:
-                self.bot.voiceline_player = voice.create_ffmpeg_player('night.wav')
-                self.bot.voiceline_player.start()
+                session.play_voiceline(voice, 'night.wav')
 
-        self.bot.voiceline_player = voice.create_ffmpeg_player('ready.wav', after=after)
-        self.bot.voiceline_player.start()
+        session.play_voiceline(voice, 'ready.wav', after=after)
 
     @command(context=PUBLIC, access=ADMIN, types=(str,))
     async def c_joinchannel(self, source, channelId):
@@ -147,13 +186,12 @@ class CommandManager:
     @command(context=PUBLIC, access=USER)
     async def c_play(self, source):
         """ Plays a random episode from the episode pool. """
-        if self.bot.episode_player and not self.bot.episode_player.is_done():
+        session = self.bot.sessions.get(source.channel.server)
+        if session.is_playing():
             await self.bot.send_message(source.channel, 'Sorry, an episode is already playing!')
             return
 
-        if self.bot.point_task:
-            self.bot.point_task.cancel()
-            self.bot.point_task = None
+        session.cancel_points()
 
         voice = self.bot.voice_client_in(source.channel.server)
         voice_channel = source.author.voice_channel
@@ -165,31 +203,14 @@ class CommandManager:
         if not voice:
             voice = await self.bot.join_voice_channel(voice_channel)
         elif voice.channel != voice_channel:
-            voice.move_to(voice_channel)
-            voice = self.bot.voice_client_in(source.channel.server)
-
-        if len(self.bot.episode_pool) == 0:
-            self.bot.episode_pool = list(range(len(self.bot.episode_data)))
-
-        index = random.randint(0, len(self.bot.episode_pool))
+            voice = await voice.move_to(voice_channel)
 
-        self.bot.current_episode = self.bot.episode_data[self.bot.episode_pool.pop(index)]
-
-        await self.bot.play_episode(source.channel, voice)
+        await session.play(session.random_episode(), source.channel, voice)
 
     @command(context=PUBLIC, access=ADMIN)
     async def c_leave(self, source):
         """ Leaves the current voice channel. """
-        if self.bot.episode_player:
-            self.bot.episode_player.stop()
-            self.bot.episode_player = None
-        if self.bot.voiceline_player:
-            self.bot.voiceline_player.stop()
-            self.bot.voiceline_player = None
-
-        if self.bot.point_task:
-            self.bot.point_task.cancel()
-            self.bot.point_task = None
+        self.bot.sessions.close(source.channel.server)
 
         voice = self.bot.voice_client_in(source.channel.server)
         if not voice:
@@ -200,13 +221,28 @@ class CommandManager:
     @command(context=PUBLIC, access=USER, types=(str,))
     async def c_request(self, source, episode):
         """ Request a certain episode to be played. """
-        if self.bot.episode_player and not self.bot.episode_player.is_done():
-            await self.bot.player.send_message(source.channel, 'Sorry, an episode is already playing!')
+        episode_data = None
+
+        for e in self.bot.episode_data:
+            if e.filename == episode:
+                episode_data = e
+
+        if episode_data is None:
+            await self.bot.send_message(source.channel, 'Sorry, that episode does not exist!')
             return
 
-        if self.bot.point_task:
-            self.bot.point_task.cancel()
-            self.bot.point_task = None
+        session = self.bot.sessions.get(source.channel.server)
+        if session.is_playing():
+            if len(session.queue) >= session.queue_size:
+                await self.bot.send_message(source.channel, 'Sorry, the queue is full!')
+                return
+
+            session.queue.append(episode_data)
+            await self.bot.send_message(
+                source.channel, '```%s is number %d in the queue.```' % (episode_data, len(session.queue)))
+            return
+
+        session.cancel_points()
 
         voice = self.bot.voice_client_in(source.channel.server)
 
@@ -216,46 +252,71 @@ class CommandManager:
             elif voice.channel != source.author.voice_channel:
                 voice = await voice.move_to(source.author.voice_channel)
 
-        episode_data = None
+        await session.play(episode_data, source.channel, voice)
 
-        for e in self.bot.episode_data:
-            if e.filename == episode:
-                episode_data = e
-
-        if episode_data is None:
-            await self.bot.send_message(source.channel, 'Sorry, that episode does not exist!')
-            return
+    @command(context=BOTH, access=ADMIN)
+    async def c_rescan(self, source):
+        """ Rescans the content directory for new or removed episodes. """
+        added, removed = await self.bot.refresh_catalog()
+        await self.bot.send_message(
+            source.channel, '```Added %d and removed %d episode(s); %d available.```'
+                            % (added, removed, len(self.bot.episode_data)))
 
-        self.bot.current_episode = episode_data
+    @command(context=BOTH, access=ADMIN)
+    async def c_sessions(self, source):
+        """ Shows how many servers are being streamed to and the CPU it takes. """
+        stats = self.bot.sessions.stats()
+        await self.bot.send_message(
+            source.channel, '```%d session(s), %d playing (peak %d), %d queued; %.0f%% of a core since last check.```'
+                            % (stats['sessions'], stats['playing'], stats['peak_playing'], stats['queued'],
+                               stats['cpu'] * 100))
+
+    @command(context=BOTH, access=ADMIN)
+    async def c_status(self, source):
+        """ Shows crate queue, ffmpeg and user cache metrics. """
+        crates = self.bot.crate_manager.crate_stats()
+        ffmpeg = self.bot.ffmpeg.stats()
+        cache = self.bot.userdb.cache_info()
+        lookups = cache['hits'] + cache['misses']
+
+        nmessage = '```'
+        nmessage += 'Crates: %d queued (max %d), %d generating, %d generated\n' \
+                    % (crates['queued'], crates['max_depth'], crates['active'], crates['generated'])
+        nmessage += 'Crate wait: %.1fs average, %.1fs max\n' % (crates['average_wait'], crates['max_wait'])
+        nmessage += 'ffmpeg: %d run(s), %d running, %d failed, %d timed out; %.2fs average, %.2fs max' \
+                    % (ffmpeg['runs'], ffmpeg['running'], ffmpeg['failures'], ffmpeg['timeouts'],
+                       ffmpeg['average_time'], ffmpeg['max_time'])
+        nmessage += '\nUser cache: %d user(s), %d hit(s), %d miss(es) (%.0f%% hit rate)' \
+                    % (cache['size'], cache['hits'], cache['misses'], 100.0 * cache['hits'] / lookups if lookups else 0)
+        nmessage += '```'
 
-        await self.bot.play_episode(source.channel, voice)
+        await self.bot.send_message(source.channel, nmessage)
 
     @command(context=PUBLIC, access=ADMIN)
     async def c_skip(self, source):
         """ Skips the episode that is playing. """
-        if self.bot.point_task:
-            self.bot.point_task.cancel()
-            self.bot.point_task = None
+        session = self.bot.sessions.find(source.channel.server)
+        if session is None:
+            return
+
+        session.cancel_points()
 
-        if self.bot.episode_player:
-            self.bot.episode_player.stop()
+        if session.episode_player:
+            session.episode_player.stop()
 
-    @command(context=BOTH, access=USER)
+    @command(context=BOTH, access=USER, aliases=('stats',))
     async def c_info(self, source):
         """ Lists the invoking user's stats. """
-        data = self.bot.userdb.get(source.author)
+        fields = ('create_date', 'current_points', 'total_points', 'crates_opened', 'episodes_watched')
+        data = await self.bot.userdb.get(source.author, fields)
 
         if data is None:
-            self.bot.userdb.insert(source.author)
-            data = self.bot.userdb.get(source.author)
+            await self.bot.userdb.insert(source.author)
+            data = await self.bot.userdb.get(source.author, fields)
 
         cdate = datetime.datetime.fromtimestamp(int(data.create_date)).strftime('%Y-%m-%d %H:%M:%S')
 
-        rank = ''
-
-        for key in sorted(RANKS.keys()):
-            if key <= data.total_points:
-                rank = RANKS[key]
+        rank = rank_title(data.total_points)
 
         nmessage = ''
         nmessage += '%s\n' % source.author.mention
@@ -270,6 +331,31 @@ class CommandManager:
 
         await self.bot.send_message(source.channel, nmessage)
 
+    @command(context=BOTH, access=USER, optional=(str,), aliases=('top',))
+    async def c_leaderboard(self, source, stat='points'):
+        """ Shows the top users by points, crates or episodes. """
+        stats = {'points': ('total_points', 'Total Points'),
+                 'crates': ('crates_opened', 'Crates Opened'),
+                 'episodes': ('episodes_watched', 'Episodes Watched')}
+        if stat not in stats:
+            await self.bot.send_message(source.channel, '```Leaderboards: %s```' % ', '.join(sorted(stats)))
+            return
+        field, title = stats[stat]
+
+        board = await self.bot.leaderboard.top(field)
+
+        nmessage = '```%s\n\n' % title
+        for position, (_, name, value) in enumerate(board, 1):
+            nmessage += '%2d. %s - %d\n' % (position, name, value)
+
+        data = await self.bot.userdb.get(source.author, (field,))
+        if data is not None:
+            value = getattr(data, field)
+            nmessage += '\nYou: #%d - %d' % (await self.bot.userdb.rank(field, value), value)
+        nmessage += '```'
+
+        await self.bot.send_message(source.channel, nmessage)
+
     @command(context=PUBLIC, access=USER, types=(str,))
     async def c_voiceline(self, source, name):
         """ Plays one of the user's voicelines. """
@@ -279,23 +365,19 @@ class CommandManager:
                                            "```You don't have any voicelines unlocked. Try opening some crates.```")
             return
 
-        if self.bot.current_episode is not None:
+        session = self.bot.sessions.get(source.channel.server)
+
+        if session.current_episode is not None:
             await self.bot.send_message(source.channel, "```An episode is playing! Wait until it is over.```")
             return
 
-        if self.bot.episode_player and not self.bot.episode_player.is_done():
+        if session.is_playing():
             await self.bot.send_message(source.channel, "```An episode is playing! Wait until it is over.```")
             return
 
-        # Get the user data
-        user = self.bot.userdb.get(source.author.id)
-        if user is None or len(user.inventory) == 0:
-            await self.bot.send_message(source.channel, '```You do not own any voicelines.```')
-
         # Get the voice line from the name
-        try:
-            voiceline = [item for item in user.inventory if item.name == name and item.item_type == 'voiceline'][0]
-        except IndexError:
+        voiceline = await self.bot.userdb.get_item(source.author.id, 'voiceline', name)
+        if voiceline is None:
             await self.bot.send_message(source.channel, '```Invalid voiceline specified.```')
             return
 
@@ -318,64 +400,59 @@ class CommandManager:
             elif voice.channel != source.author.voice_channel:
                 voice = await voice.move_to(channel)
 
-            if self.bot.voiceline_player and not self.bot.voiceline_player.is_done():
-                self.bot.voiceline_player.stop()
-
-            self.bot.voiceline_player = voice.create_ffmpeg_player(fpath)
-            self.bot.voiceline_player.start()
+            session.play_voiceline(voice, fpath)
 
-    @command(context=PRIVATE, access=USER)
+    @command(context=PRIVATE, access=USER, aliases=('crate',))
     async def c_opencrate(self, source):
         """ Opens a crate using your points. * """
         await self.bot.crate_manager.generate_crate(source)
 
-    @command(context=PRIVATE, access=USER, types=(str,))
-    async def c_list(self, source, item_type):
-        # Get the user data
-        user = self.bot.userdb.get(source.author.id)
-        if user is None or len(user.inventory) == 0:
-            await self.bot.send_message(source.channel, '```You do not own any items.```')
+    @command(context=PRIVATE, access=USER, types=(str,), optional=(int,))
+    async def c_list(self, source, item_type, page=1):
+        per_page = self.bot.config.get('list_page_size', 50)
+        items, total = await self.bot.userdb.list_items(source.author.id, item_type, max(page, 1) - 1, per_page)
+        if total == 0:
+            await self.bot.send_message(source.channel, '```You do not own any %s items.```' % item_type)
             return
 
-        item_names = [item.name for item in user.inventory if item.item_type == item_type]
-        if len(item_names) == 0:
-            await self.bot.send_message(source.channel, '```You do not own any %s items.```' % item_type)
+        pages = (total + per_page - 1) // per_page
+        if len(items) == 0:
+            await self.bot.send_message(source.channel, '```You only have %d page(s) of %s items.```' % (pages, item_type))
             return
 
-        await self.bot.send_message(source.channel, '```%s```' % ','.join(item_names))
+        output = ','.join(item.name for item in items)
+        if pages > 1:
+            output += '\n\nPage %d of %d' % (max(page, 1), pages)
+
+        await self.bot.send_message(source.channel, '```%s```' % output)
 
     @command(context=PRIVATE, access=USER, types=(str,))
     async def c_gallery(self, source, name):
         """ Shows all of your unlocked frames. * """
-        framedir = os.path.join('frames', source.author.id)
-        if not os.path.isdir(framedir):
-            await self.bot.send_message(source.channel, '```You have no frames yet! Try opening some crates!```')
-            return
-
-        # Get the user data
-        user = self.bot.userdb.get(source.author.id)
-        if user is None or len(user.inventory) == 0:
-            await self.bot.send_message(source.channel, '```You do not own any frames.```')
-
         # Get the frame from the name
-        try:
-            frame = [item for item in user.inventory if item.name == name and item.item_type == 'frame'][0]
-        except IndexError:
-            await self.bot.send_message(source.channel, '```Invalid frame specified.```')
+        frame = await self.bot.userdb.get_item(source.author.id, 'frame', name)
+        if frame is None:
+            _, total = await self.bot.userdb.list_items(source.author.id, 'frame', 0, 1)
+            if not total:
+                await self.bot.send_message(source.channel, '```You have no frames yet! Try opening some crates!```')
+            else:
+                await self.bot.send_message(source.channel, '```Invalid frame specified.```')
             return
 
+        # Items point at their frame in the frame store; older ones have a
+        # copy in the user's own directory.
+        fpath = frame.from_episode or os.path.join('frames', source.author.id, str(frame.idx) + '.png')
+
         # Check if the frame is in our file system
         try:
-            fpath = os.path.join(framedir, str(frame.idx) + '.png')
             f = open(fpath, 'rb')
         except IOError:
             await self.bot.send_message(source.channel, '```Invalid index specified.```')
         else:
-            createTime = os.stat(fpath).st_ctime
-            cdate = datetime.datetime.fromtimestamp(int(createTime)).strftime('%Y-%m-%d %H:%M:%S')
+            cdate = datetime.datetime.fromtimestamp(frame.date_received).strftime('%Y-%m-%d %H:%M:%S')
 
             await self.bot.send_message(source.channel, '```Opened %s CST:```' % cdate)
-            await self.bot.send_file(source.channel, f)
+            await self.bot.send_file(source.channel, f, filename=str(frame.idx) + os.path.splitext(fpath)[1])
 
             f.close()
 
@@ -383,12 +460,7 @@ class CommandManager:
     async def c_sell(self, source, item_type, name):
         """ Sell one of your unlocked items for 15 points. * """
         if item_type == 'frame' or item_type == 'voiceline':
-            user_data = self.bot.userdb.get(source.author)
-            if user_data is None:
-                await self.bot.send_message(
-                    source.channel, '```You do not own a %s named %s to sell.```' % (item_type, name))
-                return
-            if len([item for item in user_data.inventory if item.item_type == item_type and item.name == name]) == 0:
+            if await self.bot.userdb.get_item(source.author, item_type, name) is None:
                 await self.bot.send_message(
                     source.channel, '```You do not own a %s named %s to sell.```' % (item_type, name))
                 return
@@ -404,7 +476,7 @@ class CommandManager:
     async def c_confirm(self, source):
         """ Confirms your last request. * """
         try:
-            msg = self.bot.request_manager.confirm_request(source.author.id)
+            msg = await self.bot.request_manager.confirm_request(source.author.id)
             msg = '```%s```' % msg
             await self.bot.send_message(source.channel, msg)
         except BotRequestException as e:
@@ -414,7 +486,7 @@ class CommandManager:
     async def c_cancel(self, source):
         """ Cancels your last request. * """
         try:
-            msg = self.bot.request_manager.cancel_request(source.author.id)
+            msg = await self.bot.request_manager.cancel_request(source.author.id)
             msg = '```%s```' % msg
             await self.bot.send_message(source.channel, msg)
         except BotRequestException as e:
@@ -424,7 +496,7 @@ class CommandManager:
     async def c_undo(self, source):
         """ Undoes the user's last request. * """
         try:
-            msg = self.bot.request_manager.undo_request(source.author.id)
+            msg = await self.bot.request_manager.undo_request(source.author.id)
             msg = '```%s```' % msg
             await self.bot.send_message(source.channel, msg)
         except BotRequestException as e:
@@ -433,34 +505,20 @@ class CommandManager:
     @command(context=PRIVATE, access=USER, types=(str, str, str))
     async def c_rename(self, source, item_type, from_name, to_name):
         """ Rename one of your unlocked items. * """
-        # Get the user data
-        user = self.bot.userdb.get(source.author.id)
-        if user is None or len(user.inventory) == 0:
-            await self.bot.send_message(source.channel, '```You do not own any items to rename.```')
-            return
         if to_name.isdigit():
             await self.bot.send_message(source.channel, '```Please choose a different name; digits are reserved.```')
             return
 
-        # Get the voice line from the name
-        try:
-            item_to_rename = [item for item in user.inventory if item.name == from_name and item.item_type == item_type][0]
-        except IndexError:
+        # Get the item from the name
+        item_to_rename = await self.bot.userdb.get_item(source.author.id, item_type, from_name)
+        if item_to_rename is None:
             await self.bot.send_message(source.channel, '```You do not own a %s named %s.```' % (item_type, from_name))
             return
 
-        items_with_name = [item for item in user.inventory if item.name == to_name and item.item_type == item_type]
-        if len(items_with_name) != 0:
-            # Cannot have multiple items of the same types with similar names
+        # Cannot have multiple items of the same types with similar names
+        if not await self.bot.userdb.rename_item(source.author.id, item_type, from_name, to_name):
             await self.bot.send_message(source.channel, '```You already have a %s named %s.```' % (item_type, to_name))
             return
-
-        # Rename item
-        item_idx = user.inventory.index(item_to_rename)
-        item_to_rename.name = to_name
-        user.inventory[item_idx] = item_to_rename
-        # Update user in the database
-        self.bot.userdb.update(user, {'$set': user.as_document()})
         await self.bot.send_message(
             source.channel, '```Successfully renamed %s from %s to %s.```' % (item_type, from_name, to_name))
 
@@ -468,25 +526,26 @@ class CommandManager:
     async def c_points(self, source, t_type, amount):
         """ Add or remove points from the targeted user. """
         # Get the user data
-        user = self.bot.userdb.get(source.author.id)
+        user = await self.bot.userdb.get(source.author.id, ('current_points', 'total_points'))
 
         if user is None:
             await self.bot.send_message(source.channel, '```Invalid user.```')
             return
 
         if t_type == 'add':
-            user.total_points += amount
-            user.current_points += amount
+            increments = {'total_points': amount, 'current_points': amount}
             await self.bot.send_message(source.channel, '```Adding %s point(s) to %s.```' % (amount, source.author.name))
         elif t_type == 'remove':
-            user.total_points = max(0, user.total_points - amount)
-            user.current_points = max(0, user.current_points - amount)
+            # Never go below zero.
+            increments = {'total_points': -min(amount, user.total_points),
+                          'current_points': -min(amount, user.current_points)}
             await self.bot.send_message(source.channel, '```Removing %s point(s) from %s.```' % (amount, source.author.name))
         else:
             await self.bot.send_message(source.channel, '```Invalid use of points command.```')
             return
 
-        self.bot.userdb.update(user, {'$set': user.as_document()})
+        await self.bot.userdb.update(user, {'$inc': increments})
+        self.bot.leaderboard.invalidate('total_points')
 
     async def invalid_arguments(self, source, command_name):
         await self.bot.send_message(source.channel, '```Invalid arguments to command %s.```' % command_name)
@@ -1,3 +1,6 @@
+import bisect
+
+
 CRATE_PRICE = 20
 
 
@@ -25,3 +28,11 @@ RANKS = {
     10000: 'Sponge',
 }
 
+# RANKS as parallel sorted lists, so a title is one bisect away.
+RANK_THRESHOLDS = sorted(RANKS)
+RANK_TITLES = [RANKS[threshold] for threshold in RANK_THRESHOLDS]
+
+
+def rank_title(total_points):
+    i = bisect.bisect_right(RANK_THRESHOLDS, total_points)
+    return RANK_TITLES[i - 1] if i else ''
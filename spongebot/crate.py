@@ -1,17 +1,34 @@
+import io
 import os
 import random
+import shutil
+import tempfile
 from pydub import AudioSegment
 
+from spongebot.keyframes import KeyframeIndex
+
 
 class Crate:
-    def generate(self, *args):
+    async def generate(self, *args):
         raise NotImplementedError
 
 
 class FrameCrate(Crate):
     FRAME_DIRECTORY = 'frames'
-    COMMAND = 'ffmpeg -i "%s" -vcodec png -ss %d -s 320x240 -vframes 1 -an -f rawvideo "%s"'
-    LENGTH = (11 * 60) - 10
+    # The first -ss seeks the input to a keyframe, the second skips the few
+    # frames decoded between that keyframe and the wanted timestamp. The
+    # encoder arguments and output path come from the frame store.
+    ARGUMENTS = ['-v', 'error', '-y', '-ss', '%(seek).3f', '-i', '%(input)s', '-ss', '%(offset).3f',
+                 '-s', '320x240', '-vframes', '1', '-an', '-f', 'image2']
+    # One pass from the keyframe before the first timestamp to the last one;
+    # the select filter keeps the first frame at or after each timestamp.
+    BATCH_ARGUMENTS = ['-v', 'error', '-y', '-ss', '%(seek).3f', '-i', '%(input)s',
+                       '-t', '%(duration).3f', '-vf', '%(filter)s', '-vsync', '0', '-an',
+                       '-frames:v', '%(count)d', '-f', 'image2']
+    # With frame_batch_keyframes, only keyframes are decoded. Much faster, but
+    # a batch can only pick frames from the keyframe index (a few hundred per
+    # episode on a typical rip) instead of any second of it.
+    KEYFRAME_ONLY_ARGUMENTS = ['-skip_frame', 'nokey']
 
     def __init__(self, user_id, channel):
         self.frame = ''
@@ -19,38 +36,141 @@ class FrameCrate(Crate):
         self.crate_id = 0
         self.user_id = user_id
         self.episode = None
-
-    def generate(self, crate_manager):
-        self.episode = random.choice(crate_manager.bot.episode_data)
-
-        # too lazy to have ffmpeg read the whole file for the length.
-        # Use the episode name instead of episode number because of inconsistencies.
-        if self.episode.name == 'reef blower':
-            # Special case: this episode is 3 mins long.
-            t = random.randint(5, (60 * 3) - 10)
-        elif self.episode.name == 'gary takes a bath':
-            # 6 mins
-            t = random.randint(5, (60 * 6) - 10)
-        elif self.episode.name == 'christmas who':
-            # 20 mins
-            t = random.randint(5, (60 * 20) - 10)
-        else:
-            # 11 mins usually
-            t = random.randint(5, self.LENGTH)
-
-        inpath = self.episode.path
-
-        directory = os.path.join('frames', self.user_id)
-
-        if not os.path.isdir(directory):
-            os.mkdir(directory)
-
-        outpath = os.path.join(directory, str(self.crate_id)) + '.png'
-
-        os.system(self.COMMAND % (inpath, t, outpath))
-
-        self.frame = outpath
-        crate_manager.generated_crate_queue.append(self)
+        self.queued_at = 0
+        # Set once another worker's batch has taken this crate off its hands.
+        self.batched = False
+
+    @classmethod
+    async def generate_batch(cls, crate_manager, crates):
+        # Pooled frames are used first; the rest all come from one pass over a
+        # single episode. Returns the crates that didn't get a frame.
+        remaining = []
+        for crate in crates:
+            pooled = crate_manager.frame_pool.claim()
+            if pooled is not None:
+                crate.episode, crate.frame = pooled
+            else:
+                remaining.append(crate)
+
+        if not remaining:
+            return []
+
+        episode = random.choice(crate_manager.bot.episode_data)
+        frames = await cls.render(crate_manager, episode, len(remaining))
+
+        for crate, path in zip(remaining, frames):
+            crate.episode = episode
+            crate.frame = path
+        return remaining[len(frames):]
+
+    @classmethod
+    async def render(cls, crate_manager, episode, count):
+        # Returns the frame store paths of up to count random frames of
+        # episode, extracting only the ones the store doesn't have yet.
+        store = crate_manager.frame_store
+        config = crate_manager.bot.config
+
+        times = None
+        if count > 1 and config.get('frame_batch_keyframes', False):
+            keyframes = await crate_manager.keyframes.get(episode)
+            times = cls.random_keyframes(episode, keyframes, count)
+        # Only timestamps that are all keyframes can skip decoding the rest.
+        keyframes_only = times is not None
+        if times is None:
+            times = cls.random_times(episode, count, config.get('frame_batch_window', 120))
+
+        paths = [store.path_for(episode, t) for t in times]
+        missing = [(t, path) for t, path in zip(times, paths) if not os.path.isfile(path)]
+
+        if len(missing) > 1:
+            try:
+                await cls.extract_batch(crate_manager, episode, [t for t, _ in missing],
+                                        [path for _, path in missing], keyframes_only)
+            except Exception as e:
+                crate_manager.bot.log('Failed to extract %d frames from %s: %r' % (len(missing), episode, e))
+
+        # Whatever the single pass didn't produce is extracted one by one.
+        for t, path in missing:
+            if os.path.isfile(path):
+                continue
+            try:
+                await cls.extract(crate_manager, episode, t, path)
+            except Exception as e:
+                crate_manager.bot.log('Failed to extract a frame from %s: %r' % (episode, e))
+
+        return [path for path in paths if os.path.isfile(path)]
+
+    @staticmethod
+    def random_times(episode, count, window):
+        # Distinct whole seconds away from the intro and credits. Several are
+        # kept within one random window of the episode, so the single pass
+        # that extracts them decodes at most that much video.
+        first, last = 5, max(5, int(episode.length) - 10)
+        if count > 1 and last - first > window:
+            first = random.randint(first, last - window)
+            last = first + window
+
+        seconds = range(first, last + 1)
+        return sorted(random.sample(seconds, min(count, len(seconds))))
+
+    @staticmethod
+    def random_keyframes(episode, keyframes, count):
+        # Distinct keyframes away from the intro and credits, or None if the
+        # episode doesn't have enough of them.
+        candidates = [k for k in keyframes if 5 <= k <= episode.length - 10]
+        if len(candidates) < count:
+            return None
+        return sorted(random.sample(candidates, count))
+
+    @staticmethod
+    async def extract(crate_manager, episode, t, outpath):
+        keyframes = await crate_manager.keyframes.get(episode)
+        # Without an index, input seeking alone still beats decoding from the start.
+        seek = KeyframeIndex.before(keyframes, t) if keyframes else t
+
+        values = {'input': episode.path, 'seek': seek, 'offset': t - seek}
+        # Written next to its final name first so a half-written frame is
+        # never picked up from the store.
+        partial = outpath + '.partial'
+        crate_manager.frame_store.make_directory(partial)
+        await crate_manager.bot.ffmpeg.run([arg % values for arg in FrameCrate.ARGUMENTS] +
+                                           crate_manager.frame_store.encoder_arguments() + [partial])
+        os.replace(partial, outpath)
+
+    @staticmethod
+    async def extract_batch(crate_manager, episode, times, outpaths, keyframes_only=False):
+        # Extracts the frames at times (sorted, at least a frame apart) in a
+        # single ffmpeg run, so the episode is opened and probed once. Returns
+        # the paths that were written.
+        keyframes = await crate_manager.keyframes.get(episode)
+        seek = KeyframeIndex.before(keyframes, times[0]) if keyframes else times[0]
+        # Timestamps restart at zero after the input seek. prev_t is NaN on the
+        # first frame, which makes not(gte(...)) true.
+        select = '+'.join('gte(t,%.3f)*not(gte(prev_t,%.3f))' % (t - seek, t - seek) for t in times)
+
+        store = crate_manager.frame_store
+        for outpath in outpaths:
+            store.make_directory(outpath)
+        directory = tempfile.mkdtemp(dir=store.directory)
+        try:
+            values = {'input': episode.path, 'seek': seek, 'duration': times[-1] - seek + 1,
+                      'filter': "select='%s',scale=320:240" % select, 'count': len(times)}
+            prefix = FrameCrate.KEYFRAME_ONLY_ARGUMENTS if keyframes_only else []
+            await crate_manager.bot.ffmpeg.run(prefix + [arg % values for arg in FrameCrate.BATCH_ARGUMENTS] +
+                                               store.encoder_arguments() +
+                                               [os.path.join(directory, '%d' + store.extension)])
+
+            # Output is numbered in order, so if the filter missed any
+            # timestamp the rest can't be matched up and nothing is kept.
+            paths = [os.path.join(directory, '%d%s' % (i + 1, store.extension)) for i in range(len(outpaths))]
+            if not all(os.path.isfile(path) for path in paths):
+                return []
+
+            for path, outpath in zip(paths, outpaths):
+                os.replace(path, outpath)
+            return outpaths
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
 
 
 class VoicelineCrate(Crate):
@@ -63,14 +183,13 @@ class VoicelineCrate(Crate):
         self.user_id = user_id
         self.episode = ''
         self.type = 0
+        self.queued_at = 0
 
-    def generate(self, crate_manager):
+    async def generate(self, crate_manager):
         self.episode = random.choice(crate_manager.bot.episode_data)
 
         inpath = self.episode.path
 
-        audio = AudioSegment.from_file(inpath, 'avi')
-
         intro = 5
         outro = 5
 
@@ -85,14 +204,9 @@ class VoicelineCrate(Crate):
             clip = 3
             self.type = 1
 
-        length = int(len(audio) / 1000) - outro - clip
-
-        start = random.randint(intro, length) * 1000  # time in ms
+        length = max(intro, int(self.episode.length) - outro - clip)
 
-        voiceline = audio[start:start + (clip * 1000)]
-
-        s = AudioSegment.silent(duration=250)
-        voiceline = voiceline.append(s, crossfade=250)
+        start = random.randint(intro, length)
 
         directory = os.path.join(self.VOICELINE_DIRECTORY, str(self.user_id))
 
@@ -101,8 +215,28 @@ class VoicelineCrate(Crate):
 
         outpath = os.path.join(directory, '%s.wav' % self.crate_id)
 
-        voiceline.export(outpath, format='wav')
+        if crate_manager.audio_store.enabled:
+            await crate_manager.audio_store.clip(self.episode, start, clip, outpath)
+        else:
+            clip_data = await self.extract(crate_manager.bot.ffmpeg, inpath, start, clip)
+            await crate_manager.bot.loop.run_in_executor(crate_manager.get_process_executor(),
+                                                         self.render, clip_data, outpath)
 
         self.voiceline = outpath
 
-        crate_manager.generated_crate_queue.append(self)
+    @staticmethod
+    def render(clip_data, outpath):
+        # Runs in a worker process.
+        voiceline = AudioSegment.from_file(io.BytesIO(clip_data), 'wav')
+
+        s = AudioSegment.silent(duration=250)
+        voiceline = voiceline.append(s, crossfade=250)
+
+        voiceline.export(outpath, format='wav')
+
+    @staticmethod
+    async def extract(ffmpeg, inpath, start, duration):
+        # -ss before -i seeks the input, so only the requested window is
+        # demuxed and decoded instead of the whole episode.
+        return await ffmpeg.run(['-v', 'error', '-ss', str(start), '-t', str(duration), '-i', inpath,
+                                 '-vn', '-f', 'wav', 'pipe:1'])
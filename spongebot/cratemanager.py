@@ -1,33 +1,96 @@
 from random import Random
+from concurrent.futures import ProcessPoolExecutor
+import os
 import time
 import asyncio
 
+from spongebot.audiostore import AudioStore
 from spongebot.crate import FrameCrate, VoicelineCrate
 from spongebot.constants import CRATE_PRICE
+from spongebot.framepool import FramePool
+from spongebot.framestore import FrameStore
+from spongebot.keyframes import KeyframeIndex
 from spongebot.userdb import FrameInventoryItem, VoicelineInventoryItem
 
 
 class CrateManager:
     def __init__(self, bot):
         self.bot = bot
-        self.crate_queue = []
-        self.generated_crate_queue = []
+        self.crate_queue = asyncio.Queue(loop=bot.loop)
+        self.generated_crate_queue = asyncio.Queue(loop=bot.loop)
+        self.tasks_started = False
         self.rng = Random()
+        self.audio_store = AudioStore(bot)
+        self.frame_pool = FramePool(bot)
+        self.frame_store = FrameStore(bot)
+        self.keyframes = KeyframeIndex(bot)
+
+        self.process_executor = None
+        self.active = 0
+        # user_id -> crates queued, generating or waiting for delivery
+        self.pending = {}
+        # Frame crates still sitting in crate_queue, oldest first.
+        self.queued_frames = []
+
+        self.generated_count = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.max_depth = 0
+
+    @property
+    def workers(self):
+        return self.bot.config.get('crate_workers', 2)
+
+    @property
+    def frame_batch_size(self):
+        return self.bot.config.get('frame_batch_size', 8)
+
+    def get_process_executor(self):
+        # Audio processing in pydub is CPU bound, so it gets real processes.
+        if self.process_executor is None:
+            self.process_executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self.process_executor
+
+    def crate_stats(self):
+        average_wait = self.total_wait / self.generated_count if self.generated_count else 0.0
+        return {'queued': self.crate_queue.qsize(), 'active': self.active, 'generated': self.generated_count,
+                'average_wait': average_wait, 'max_wait': self.max_wait, 'max_depth': self.max_depth}
 
     def initialize_tasks(self):
-        self.bot.loop.create_task(self.generate_crate_task())
+        # on_ready fires again after a reconnect.
+        if self.tasks_started:
+            return
+        self.tasks_started = True
+
+        for _ in range(self.workers):
+            self.bot.loop.create_task(self.generate_crate_task())
         self.bot.loop.create_task(self.deliver_crate_task())
+        self.bot.loop.create_task(self.frame_pool.refill_task())
 
     async def generate_crate(self, source):
-        data = self.bot.userdb.get(source.author)
-        if data is None:
-            await self.bot.send_message(source.channel, '```You need at least %d points to open a crate.```' % CRATE_PRICE)
+        user_id = source.author.id
+
+        if self.crate_queue.qsize() >= self.bot.config.get('crate_queue_size', 20):
+            await self.bot.send_message(source.channel, '```The crate queue is full. Try again in a minute.```')
             return
 
-        if data.current_points < CRATE_PRICE:
-            await self.bot.send_message(source.channel, '```You need at least %d points to open a crate.```' % CRATE_PRICE)
+        user_limit = self.bot.config.get('crate_user_limit', 2)
+        if self.pending.get(user_id, 0) >= user_limit:
+            await self.bot.send_message(
+                source.channel, '```You already have %d crate(s) being opened. Wait for them first.```' % user_limit)
             return
 
+        # Hold the slot while we talk to the database.
+        self.pending[user_id] = self.pending.get(user_id, 0) + 1
+        try:
+            queued = await self.charge_crate(source)
+        except Exception:
+            self.release_crate(user_id)
+            raise
+        if not queued:
+            self.release_crate(user_id)
+
+    async def charge_crate(self, source):
         self.bot.log('Generating crate type...')
 
         self.rng.seed(str(time.time()) + str(source.author.id) + str(id(self)))
@@ -41,79 +104,170 @@ class CrateManager:
             crate = FrameCrate(source.author.id, source.channel)
             crate_field = 'frame_id'
 
-        self.bot.userdb.update(source.author, {'$inc': {'crates_opened': 1, 'current_points': -CRATE_PRICE, crate_field: 1}})
+        # The balance check, the charge and the new crate id are one atomic
+        # update, so two crates opened at once can't both spend the same points
+        # or get the same id.
+        data = await self.bot.userdb.charge(source.author, CRATE_PRICE, {'crates_opened': 1, crate_field: 1},
+                                            (crate_field,))
+        if data is None:
+            await self.bot.send_message(source.channel, '```You need at least %d points to open a crate.```' % CRATE_PRICE)
+            return False
+
+        crate.crate_id = getattr(data, crate_field)
 
-        data = self.bot.userdb.get(source.author)
+        self.bot.log('Adding crate type %s to queue for %s...' % (crate.__class__.__name__, crate.user_id))
 
+        crate.queued_at = time.time()
+        self.crate_queue.put_nowait(crate)
         if isinstance(crate, FrameCrate):
-            crate.crate_id = data.frame_id
-        elif isinstance(crate, VoicelineCrate):
-            crate.crate_id = data.voiceline_id
+            self.queued_frames.append(crate)
+        self.max_depth = max(self.max_depth, self.crate_queue.qsize())
 
-        await self.bot.send_message(source.channel, '```Opening a crate for you... This might take a few seconds...```')
+        # Crates beyond the free workers have to wait their turn.
+        position = self.crate_queue.qsize() - max(0, self.workers - self.active)
+        if position > 0:
+            await self.bot.send_message(
+                source.channel, '```Opening a crate for you... You are number %d in the queue.```' % position)
+        else:
+            await self.bot.send_message(source.channel, '```Opening a crate for you... This might take a few seconds...```')
 
-        self.bot.log('Adding crate type %s to queue for %s...' % (crate.__class__.__name__, crate.user_id))
+        return True
 
-        self.crate_queue.append(crate)
+    def release_crate(self, user_id):
+        self.pending[user_id] -= 1
+        if self.pending[user_id] <= 0:
+            del self.pending[user_id]
 
     async def generate_crate_task(self):
+        # One of crate_workers consumers; each picks up a crate the moment
+        # one is queued.
         while True:
-            if self.bot.is_closed:
-                await asyncio.sleep(1, loop=self.bot.loop)
+            crate = await self.crate_queue.get()
+
+            try:
+                if isinstance(crate, FrameCrate):
+                    if not crate.batched:
+                        await self.run_frame_batch(self.take_frame_batch(crate))
+                else:
+                    await self.run_crate(crate)
+            except Exception as e:
+                self.bot.log('Failed to run crate for %s: %r' % (crate.user_id, e))
+
+    def take_frame_batch(self, crate):
+        # The crate plus the frame crates queued behind it; those stay in
+        # crate_queue and are skipped when a worker reaches them.
+        self.queued_frames.remove(crate)
+
+        batch = [crate]
+        while self.queued_frames and len(batch) < self.frame_batch_size:
+            other = self.queued_frames.pop(0)
+            other.batched = True
+            batch.append(other)
+        return batch
+
+    def record_wait(self, crate):
+        wait = time.time() - crate.queued_at
+        self.generated_count += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        return wait
+
+    async def run_crate(self, crate):
+        self.active += 1
+
+        wait = self.record_wait(crate)
+
+        self.bot.log('Generating crate for %s after %.1fs in queue (%d queued, %d active)...'
+                     % (crate.user_id, wait, self.crate_queue.qsize(), self.active))
+        try:
+            await crate.generate(self)
+        except Exception as e:
+            self.bot.log('Failed to generate crate for %s: %r' % (crate.user_id, e))
+            await self.refund_crate(crate)
+        else:
+            self.generated_crate_queue.put_nowait(crate)
+        finally:
+            self.active -= 1
+
+    async def run_frame_batch(self, crates):
+        self.active += 1
+
+        wait = max(self.record_wait(crate) for crate in crates)
+
+        self.bot.log('Generating %d frame crate(s) after up to %.1fs in queue (%d queued, %d active)...'
+                     % (len(crates), wait, self.crate_queue.qsize(), self.active))
+        try:
+            await FrameCrate.generate_batch(self, crates)
+        except Exception as e:
+            self.bot.log('Failed to generate %d frame crate(s): %r' % (len(crates), e))
+        finally:
+            self.active -= 1
+
+        # Crates that got a frame, pooled or extracted, are delivered even if
+        # the rest of the batch failed.
+        for crate in crates:
+            if crate.frame:
+                self.generated_crate_queue.put_nowait(crate)
                 continue
-            if len(self.crate_queue):
-                crate = self.crate_queue.pop(0)
-                self.bot.log('Generating crate for %s...' % crate.user_id)
-                future = self.bot.loop.run_in_executor(None,
-                                                       crate.generate, self)
-                await future
 
-            await asyncio.sleep(1, loop=self.bot.loop)
+            # One failed refund mustn't leave the rest of the batch hanging.
+            try:
+                await self.refund_crate(crate)
+            except Exception as e:
+                self.bot.log('Failed to refund crate for %s: %r' % (crate.user_id, e))
+
+    async def refund_crate(self, crate):
+        self.release_crate(crate.user_id)
+        await self.bot.userdb.update(crate.user_id, {'$inc': {'crates_opened': -1, 'current_points': CRATE_PRICE}})
+
+        # The points are back either way; the notice can fail on closed DMs.
+        try:
+            await self.bot.send_message(crate.channel,
+                                        '```Something went wrong opening your crate. Your points were refunded.```')
+        except Exception as e:
+            self.bot.log('Failed to tell %s about their refund: %r' % (crate.user_id, e))
 
     async def deliver_crate_task(self):
         while True:
-            if self.bot.is_closed:
-                await asyncio.sleep(1, loop=self.bot.loop)
-                continue
-            if len(self.generated_crate_queue):
-                crate = self.generated_crate_queue.pop(0)
-                # Get user's db data
-                user = self.bot.userdb.get(crate.user_id)
+            crate = await self.generated_crate_queue.get()
+            self.release_crate(crate.user_id)
 
-                self.bot.log('Delivering crate for %s...' % crate.user_id)
+            try:
+                await self.deliver_crate(crate)
+            except Exception as e:
+                self.bot.log('Failed to deliver crate for %s: %r' % (crate.user_id, e))
 
-                await self.bot.send_message(crate.channel, '```Crate opened!```')
+    async def deliver_crate(self, crate):
+        self.bot.log('Delivering crate for %s...' % crate.user_id)
 
-                if isinstance(crate, FrameCrate):
-                    # Add crate item to user inventory
-                    item = FrameInventoryItem(
-                        'frame', int(time.time()), str(crate.crate_id), crate.crate_id, crate.frame)
-                    user.inventory.append(item)
-                    # Update user db
-                    self.bot.userdb.update(crate.user_id, {'$set': user.as_document()})
-                    await self.bot.send_message(crate.channel, '```You got a Frame Crate!```')
-
-                    with open(crate.frame, 'rb') as fb:
-                        await self.bot.send_file(crate.channel, fb)
-
-                elif isinstance(crate, VoicelineCrate):
-                    # Add crate item to user inventory
-                    item = VoicelineInventoryItem(
-                        'voiceline', int(time.time()), str(crate.crate_id), crate.crate_id, crate.voiceline)
-                    user.inventory.append(item)
-                    # Update user db
-                    self.bot.userdb.update(crate.user_id, {'$set': user.as_document()})
-                    if crate.type == 3:
-                        name = 'Long Voiceline Crate'
-                    elif crate.type == 2:
-                        name = 'Medium Voiceline Crate'
-                    else:
-                        name = 'Short Voiceline Crate'
-
-                    await self.bot.send_message(crate.channel, '```You got a %s!```' % name)
-                    await self.bot.send_message(
-                        crate.channel,
-                        'You can play your new voiceline by using the ```$voiceline %d``` command in the server chat.'
-                        % crate.crate_id)
-
-            await asyncio.sleep(1, loop=self.bot.loop)
+        await self.bot.send_message(crate.channel, '```Crate opened!```')
+
+        if isinstance(crate, FrameCrate):
+            # Add crate item to user inventory
+            item = FrameInventoryItem(
+                'frame', int(time.time()), str(crate.crate_id), crate.crate_id, crate.frame)
+            await self.bot.userdb.add_item(crate.user_id, item)
+            await self.bot.send_message(crate.channel, '```You got a Frame Crate!```')
+
+            # The stored name is a hash; upload it under the crate's number.
+            with open(crate.frame, 'rb') as fb:
+                await self.bot.send_file(
+                    crate.channel, fb, filename=str(crate.crate_id) + os.path.splitext(crate.frame)[1])
+
+        elif isinstance(crate, VoicelineCrate):
+            # Add crate item to user inventory
+            item = VoicelineInventoryItem(
+                'voiceline', int(time.time()), str(crate.crate_id), crate.crate_id, crate.voiceline)
+            await self.bot.userdb.add_item(crate.user_id, item)
+            if crate.type == 3:
+                name = 'Long Voiceline Crate'
+            elif crate.type == 2:
+                name = 'Medium Voiceline Crate'
+            else:
+                name = 'Short Voiceline Crate'
+
+            await self.bot.send_message(crate.channel, '```You got a %s!```' % name)
+            await self.bot.send_message(
+                crate.channel,
+                'You can play your new voiceline by using the ```$voiceline %d``` command in the server chat.'
+                % crate.crate_id)
@@ -0,0 +1,101 @@
+import asyncio
+import subprocess
+import time
+
+
+class FFmpegError(Exception):
+    def __init__(self, message):
+        Exception.__init__(self, message)
+        self.message = message
+
+
+class FFmpegRunner:
+    # Runs ffmpeg as an asyncio subprocess, so crate work doesn't tie up a
+    # thread per process and a stalled ffmpeg can be timed out and killed.
+    def __init__(self, bot):
+        self.bot = bot
+        self.processes = set()
+        # Set on shutdown; nothing new is started after that.
+        self.closed = False
+
+        self.runs = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    async def run(self, args, timeout=None, retries=None, executable=None):
+        # Returns ffmpeg's stdout. Raises FFmpegError once every attempt has
+        # failed or timed out.
+        if executable is None:
+            executable = self.bot.config.get('ffmpeg_path', 'ffmpeg')
+        if timeout is None:
+            timeout = self.bot.config.get('ffmpeg_timeout', 60)
+        if retries is None:
+            retries = self.bot.config.get('ffmpeg_retries', 1)
+
+        error = None
+        for attempt in range(retries + 1):
+            if self.closed:
+                raise FFmpegError('ffmpeg runner is closed')
+
+            start = time.time()
+            process = await asyncio.create_subprocess_exec(executable, *args,
+                                                           stdin=subprocess.DEVNULL,
+                                                           stdout=subprocess.PIPE,
+                                                           stderr=subprocess.PIPE,
+                                                           loop=self.bot.loop)
+            self.processes.add(process)
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(), timeout, loop=self.bot.loop)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                error = FFmpegError('ffmpeg timed out after %gs' % timeout)
+                await self.kill(process)
+                continue
+            except asyncio.CancelledError:
+                await self.kill(process)
+                raise
+            finally:
+                self.processes.discard(process)
+                self.record(time.time() - start)
+
+            if process.returncode == 0:
+                return stdout
+
+            error = FFmpegError('ffmpeg exited with status %d: %s'
+                                % (process.returncode, stderr.decode('utf-8', 'replace').strip()[-500:]))
+            self.bot.log('%s (attempt %d of %d)' % (error.message, attempt + 1, retries + 1))
+
+        self.failures += 1
+        raise error
+
+    async def kill(self, process):
+        if process.returncode is None:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+            await process.wait()
+
+    def close(self):
+        # Called on shutdown; anything still running is killed and its run()
+        # fails instead of retrying.
+        self.closed = True
+        for process in list(self.processes):
+            if process.returncode is None:
+                try:
+                    process.kill()
+                except ProcessLookupError:
+                    pass
+        self.processes.clear()
+
+    def record(self, elapsed):
+        self.runs += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+
+    def stats(self):
+        average = self.total_time / self.runs if self.runs else 0.0
+        return {'runs': self.runs, 'failures': self.failures, 'timeouts': self.timeouts,
+                'running': len(self.processes), 'average_time': average, 'max_time': self.max_time}
@@ -0,0 +1,58 @@
+import asyncio
+import random
+
+from spongebot.crate import FrameCrate
+
+
+class FramePool:
+    # Random frames extracted in the background while the bot is idle, so
+    # opening a frame crate only has to hand one out.
+    def __init__(self, bot):
+        self.bot = bot
+        self.frames = []  # (episode, frame store path)
+
+    @property
+    def size(self):
+        return self.bot.config.get('frame_pool_size', 10)
+
+    def claim(self):
+        try:
+            return self.frames.pop(0)
+        except IndexError:
+            return None
+
+    def is_busy(self):
+        return not self.bot.crate_manager.crate_queue.empty()
+
+    def is_streaming(self):
+        return bool(self.bot.sessions.playing())
+
+    async def refill_task(self):
+        while True:
+            if self.bot.is_closed or len(self.frames) >= self.size or \
+                    not self.bot.episode_data or self.is_busy():
+                await asyncio.sleep(1, loop=self.bot.loop)
+                continue
+
+            try:
+                await self.render()
+            except Exception as e:
+                self.bot.log('Failed to render a pooled frame: %r' % e)
+                await asyncio.sleep(self.bot.config.get('frame_pool_stream_delay', 30), loop=self.bot.loop)
+                continue
+
+            # Don't compete with ffmpeg streaming an episode for CPU.
+            if self.is_streaming():
+                await asyncio.sleep(self.bot.config.get('frame_pool_stream_delay', 30), loop=self.bot.loop)
+
+    async def render(self):
+        # Tops the pool up from one episode per pass.
+        episode = random.choice(self.bot.episode_data)
+
+        count = min(self.size - len(self.frames), self.bot.crate_manager.frame_batch_size)
+        done = await FrameCrate.render(self.bot.crate_manager, episode, count)
+        if not done:
+            raise RuntimeError('No frames were extracted from %s' % episode)
+
+        for path in done:
+            self.frames.append((episode, path))
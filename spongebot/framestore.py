@@ -0,0 +1,46 @@
+import os
+
+from spongebot.crate import FrameCrate
+
+
+class FrameStore:
+    # Frames are stored once per episode timestamp, named by a hash of the
+    # two, and inventory items point at the shared file instead of each user
+    # getting their own copy.
+    FORMATS = ('png', 'webp')
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    @property
+    def directory(self):
+        return self.bot.config.get('frame_store_directory', os.path.join(FrameCrate.FRAME_DIRECTORY, 'store'))
+
+    @property
+    def format(self):
+        frame_format = self.bot.config.get('frame_format', 'png')
+        if frame_format not in self.FORMATS:
+            raise ValueError('frame_format must be one of %s, not %r' % (', '.join(self.FORMATS), frame_format))
+        return frame_format
+
+    @property
+    def extension(self):
+        return '.' + self.format
+
+    def encoder_arguments(self):
+        if self.format == 'webp':
+            return ['-vcodec', 'libwebp', '-quality', str(self.bot.config.get('frame_webp_quality', 80)),
+                    '-compression_level', '6']
+        # Same pixels as before, just a smaller file.
+        return ['-vcodec', 'png', '-pred', 'mixed', '-compression_level', '9']
+
+    def path_for(self, episode, t):
+        digest = episode.cache_key('%.3f' % t)
+        return os.path.join(self.directory, digest[:2], digest + self.extension)
+
+    def make_directory(self, path):
+        # Called when a frame is about to be written to path, rather than for
+        # every candidate timestamp whose path is looked up.
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
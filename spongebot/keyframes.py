@@ -0,0 +1,92 @@
+import bisect
+import json
+import os
+
+
+class KeyframeIndex:
+    # Keyframe timestamps of each episode's video stream, probed once and kept
+    # on disk, so frame extraction can seek straight to the keyframe before
+    # the wanted timestamp and decode only the frames after it.
+    def __init__(self, bot):
+        self.bot = bot
+        self.indexes = {}
+
+    @property
+    def directory(self):
+        return self.bot.config.get('keyframe_directory', 'keyframes')
+
+    def path_for(self, episode):
+        return os.path.join(self.directory, episode.cache_key() + '.json')
+
+    async def get(self, episode):
+        # Returns the sorted keyframe times, or an empty list if the episode
+        # can't be indexed.
+        path = self.path_for(episode)
+
+        keyframes = self.indexes.get(path)
+        if keyframes is not None:
+            return keyframes
+
+        try:
+            with open(path, 'r') as f:
+                keyframes = json.load(f)
+        except (IOError, ValueError):
+            keyframes = await self.probe(episode)
+            if keyframes:
+                self.save(path, keyframes)
+
+        self.indexes[path] = keyframes
+        return keyframes
+
+    # Reads packet headers only; nothing is decoded.
+    PROBE_ARGUMENTS = ['-v', 'error', '-select_streams', 'v:0', '-show_entries', 'packet=pts_time,dts_time,flags',
+                       '-of', 'csv=print_section=0']
+
+    async def probe(self, episode):
+        try:
+            output = await self.bot.ffmpeg.run(
+                self.PROBE_ARGUMENTS + [episode.path],
+                executable=self.bot.config.get('ffprobe_path', 'ffprobe'),
+                timeout=self.bot.config.get('keyframe_probe_timeout', 120))
+        except Exception as e:
+            self.bot.log('Failed to index keyframes of %s: %r' % (episode.path, e))
+            return []
+
+        keyframes = self.parse(output)
+        self.bot.log('Indexed %d keyframes in %s.' % (len(keyframes), episode))
+        return keyframes
+
+    @staticmethod
+    def parse(output):
+        # Sorted keyframe times from PROBE_ARGUMENTS' output.
+        keyframes = []
+        for line in output.decode('utf-8', 'replace').splitlines():
+            fields = line.split(',')
+            if len(fields) < 3 or 'K' not in fields[2]:
+                continue
+            for value in fields[:2]:
+                try:
+                    keyframes.append(float(value))
+                    break
+                except ValueError:
+                    continue
+
+        keyframes.sort()
+        return keyframes
+
+    def save(self, path, keyframes):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        partial = path + '.tmp'
+        with open(partial, 'w') as f:
+            json.dump(keyframes, f)
+        os.replace(partial, path)
+
+    @staticmethod
+    def before(keyframes, t):
+        # The last keyframe at or before t, or 0 if there is none.
+        i = bisect.bisect_right(keyframes, t)
+        if i == 0:
+            return 0.0
+        return keyframes[i - 1]
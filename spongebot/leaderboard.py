@@ -0,0 +1,59 @@
+import time
+
+
+class Leaderboard:
+    # The top users of each stat, read from the sorted indexes and kept in
+    # memory. Points handed out by give_points are applied to the cached
+    # total_points board as they happen; everything else expires after
+    # leaderboard_ttl seconds.
+    STATS = ('total_points', 'crates_opened', 'episodes_watched')
+
+    def __init__(self, bot):
+        self.bot = bot
+        # stat -> (expiry, [(user_id, name, value), ...])
+        self.boards = {}
+
+    @property
+    def size(self):
+        return self.bot.config.get('leaderboard_size', 10)
+
+    @property
+    def ttl(self):
+        return self.bot.config.get('leaderboard_ttl', 300)
+
+    async def top(self, stat):
+        cached = self.boards.get(stat)
+        if cached is not None and time.monotonic() < cached[0]:
+            return cached[1]
+
+        board = await self.bot.userdb.top_users(stat, self.size)
+        self.boards[stat] = (time.monotonic() + self.ttl, board)
+        return board
+
+    def invalidate(self, stat=None):
+        if stat is None:
+            self.boards.clear()
+        else:
+            self.boards.pop(stat, None)
+
+    async def add_points(self, users, points):
+        # Everyone on the board who got points moves up in place. Anyone else
+        # could only pass the lowest entry if they were tied with it, so only
+        # they are looked up, and only if they beat it now.
+        cached = self.boards.get('total_points')
+        if cached is None or time.monotonic() >= cached[0]:
+            return
+        expiry, board = cached
+
+        user_ids = set(user.id for user in users)
+        board = [(user_id, name, value + points if user_id in user_ids else value)
+                 for user_id, name, value in board]
+        outsiders = user_ids.difference(user_id for user_id, _, _ in board)
+
+        if outsiders:
+            # A short board holds every user with points, so any outsider belongs on it.
+            floor = min(value for _, _, value in board) if len(board) >= self.size else None
+            board += await self.bot.userdb.top_users('total_points', self.size, outsiders, floor)
+
+        board.sort(key=lambda entry: entry[2], reverse=True)
+        self.boards['total_points'] = (expiry, board[:self.size])
@@ -0,0 +1,96 @@
+import time
+
+
+class TokenBucket:
+    __slots__ = ('capacity', 'rate', 'tokens', 'updated', 'notified_until')
+
+    def __init__(self, capacity, per, now):
+        self.capacity = capacity
+        self.rate = capacity / per
+        self.tokens = capacity
+        self.updated = now
+        # Throttle notices are sent at most once until this time.
+        self.notified_until = 0
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def retry_after(self):
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    # Token buckets per user and per channel for each command, checked in
+    # memory before a command does any I/O. Limits are [uses, seconds] and
+    # can be set per command under rate_limits in config.json, e.g.
+    #   "rate_limits": {"default": {"user": [5, 10]}, "opencrate": {"user": [2, 30], "channel": [6, 30]}}
+    DEFAULT_LIMITS = {
+        'default': {'user': [5, 10]},
+        'opencrate': {'user': [2, 30], 'channel': [6, 30]},
+        'play': {'user': [2, 30], 'channel': [3, 30]},
+        'request': {'user': [2, 30], 'channel': [3, 30]},
+        'voiceline': {'user': [3, 10], 'channel': [6, 10]},
+    }
+    # Full buckets are dropped after this many checks.
+    PRUNE_INTERVAL = 1000
+
+    NOTICES = {
+        'user': '```Slow down! Try that again in %d second(s).```',
+        'channel': '```This channel is using that command too much. Try again in %d second(s).```',
+    }
+
+    def __init__(self, bot):
+        self.bot = bot
+        # (scope, command, user or channel id) -> TokenBucket
+        self.buckets = {}
+        self.checks = 0
+        self.throttled = 0
+
+    def limits_for(self, command_name):
+        limits = self.bot.config.get('rate_limits', {})
+        return limits.get(command_name) or self.DEFAULT_LIMITS.get(command_name) or \
+            limits.get('default') or self.DEFAULT_LIMITS['default']
+
+    def check(self, command_name, user_id, channel_id):
+        # Returns (allowed, notice). notice is the reply to send when a
+        # command is refused, or None if the user was already told.
+        now = time.monotonic()
+
+        self.checks += 1
+        if self.checks % self.PRUNE_INTERVAL == 0:
+            self.prune(now)
+
+        ids = {'user': user_id, 'channel': channel_id}
+        buckets = []
+        for scope, (uses, per) in self.limits_for(command_name).items():
+            key = (scope, command_name, ids[scope])
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(uses, per, now)
+            bucket.refill(now)
+            buckets.append((scope, bucket))
+
+        # Nothing is taken unless every bucket has a token to give.
+        for scope, bucket in buckets:
+            if bucket.tokens < 1:
+                self.throttled += 1
+                if now < bucket.notified_until:
+                    return False, None
+
+                retry_after = bucket.retry_after()
+                bucket.notified_until = now + retry_after
+                return False, self.NOTICES[scope] % max(1, round(retry_after))
+
+        for _, bucket in buckets:
+            bucket.tokens -= 1
+        return True, None
+
+    def prune(self, now):
+        for key, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity and now >= bucket.notified_until:
+                del self.buckets[key]
+
+    def stats(self):
+        return {'buckets': len(self.buckets), 'checks': self.checks, 'throttled': self.throttled}
@@ -9,22 +9,22 @@ class RequestManager:
     def create_request(self, request):
         self.user_requests[request.requester] = request
 
-    def confirm_request(self, user_id):
+    async def confirm_request(self, user_id):
         try:
-            return self.user_requests[user_id].confirm()
+            return await self.user_requests[user_id].confirm()
         except KeyError:
             raise BotRequestException('No request to confirm.')
 
-    def cancel_request(self, user_id):
+    async def cancel_request(self, user_id):
         try:
-            msg = self.user_requests[user_id].cancel()
+            msg = await self.user_requests[user_id].cancel()
             del self.user_requests[user_id]
             return msg
         except KeyError:
             raise BotRequestException('No request to cancel.')
 
-    def undo_request(self, user_id):
+    async def undo_request(self, user_id):
         try:
-            return self.user_requests[user_id].undo()
+            return await self.user_requests[user_id].undo()
         except KeyError:
             raise BotRequestException('No request to undo.')
\ No newline at end of file
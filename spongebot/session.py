@@ -0,0 +1,201 @@
+import asyncio
+import random
+import time
+
+
+class GuildSession:
+    # Playback state of one server, so every server the bot is in can watch
+    # its own episode at the same time.
+    def __init__(self, bot, server):
+        self.bot = bot
+        self.server = server
+
+        self.current_episode = None
+        self.episode_player = None
+        self.voiceline_player = None
+        self.point_task = None
+        self.text_channel = None
+
+        # Episodes left before any of them repeats.
+        self.episode_pool = []
+        # Requested episodes waiting for the current one to end.
+        self.queue = []
+
+    @property
+    def queue_size(self):
+        return self.bot.config.get('session_queue_size', 10)
+
+    def is_playing(self):
+        return self.episode_player is not None and not self.episode_player.is_done()
+
+    def random_episode(self):
+        if not self.episode_pool:
+            self.episode_pool = list(self.bot.episode_data)
+
+        return self.episode_pool.pop(random.randrange(len(self.episode_pool)))
+
+    def cancel_points(self):
+        if self.point_task:
+            self.point_task.cancel()
+            self.point_task = None
+
+    def play_voiceline(self, voice, path, after=None):
+        if self.voiceline_player is not None and not self.voiceline_player.is_done():
+            self.voiceline_player.stop()
+
+        self.voiceline_player = voice.create_ffmpeg_player(path, after=after)
+        self.voiceline_player.start()
+
+    def stop(self):
+        # Nothing queued plays after this.
+        del self.queue[:]
+        self.cancel_points()
+
+        if self.episode_player:
+            self.episode_player.stop()
+            self.episode_player = None
+        if self.voiceline_player:
+            self.voiceline_player.stop()
+            self.voiceline_player = None
+
+    async def play(self, episode, text_channel, voice):
+        self.current_episode = episode
+        self.text_channel = text_channel
+
+        play_message = ''
+        play_message += '```Playing episode %s from season %s.```\n' % (episode.episode, episode.season)
+        play_message += '```Every minute you listen to the episode you will gain 1 point.```\n'
+        play_message += "```Use $info to see your stats.```\n"
+        await self.bot.send_message(text_channel, play_message)
+
+        self.bot.log('Playing episode %s in %s...' % (str(episode), self.server.name))
+
+        def after():
+            # Runs on the player's thread.
+            asyncio.run_coroutine_threadsafe(self.on_episode_end(episode), self.bot.loop)
+
+        if self.voiceline_player is not None and not self.voiceline_player.is_done():
+            self.voiceline_player.stop()
+
+        if self.is_playing():
+            self.episode_player.stop()
+        self.episode_player = voice.create_ffmpeg_player(episode.path, after=after)
+        self.episode_player.start()
+        self.bot.sessions.record_playing()
+
+        self.cancel_points()
+        self.point_task = self.bot.loop.call_later(60, self.point_tick)
+
+    async def on_episode_end(self, episode):
+        # A player replaced by a newer episode ends too; that one isn't over.
+        if episode is not self.current_episode:
+            return
+
+        self.current_episode = None
+        self.cancel_points()
+
+        voice = self.bot.voice_client_in(self.server)
+
+        if not voice:
+            return
+
+        for member in voice.channel.voice_members:
+            if member.voice.deaf or member.voice.self_deaf or member.voice.is_afk:
+                continue
+
+            await self.bot.userdb.update(member, {'$inc': {'episodes_watched': 1}})
+            await self.bot.userdb.update(member, {'$push': {'episode_list': str(episode)}})
+
+        if self.queue and self.current_episode is None:
+            await self.play(self.queue.pop(0), self.text_channel, voice)
+
+    def point_tick(self):
+        self.point_task = self.bot.loop.create_task(self.give_points())
+
+    async def give_points(self):
+        if not self.is_playing():
+            return
+
+        voice = self.bot.voice_client_in(self.server)
+
+        if not voice:
+            return
+
+        self.bot.log('Updating points in %s...' % self.server.name)
+
+        listeners = [member for member in voice.channel.voice_members
+                     if not (member.voice.deaf or member.voice.self_deaf or member.voice.is_afk)]
+
+        # One failed tick mustn't stop points for the rest of the episode. A
+        # cancel from cancel_points is the one thing that does.
+        try:
+            start = time.time()
+            await self.bot.userdb.bulk_upsert(listeners, {'$inc': {'current_points': 1, 'total_points': 1}})
+            self.bot.log('Updated points for %d listener(s) in %.1f ms.'
+                         % (len(listeners), (time.time() - start) * 1000))
+            await self.bot.leaderboard.add_points(listeners, 1)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.bot.log('Failed to update points in %s: %r' % (self.server.name, e))
+
+        self.point_task = self.bot.loop.call_later(60, self.point_tick)
+
+
+class SessionRegistry:
+    def __init__(self, bot):
+        self.bot = bot
+        # server id -> GuildSession
+        self.sessions = {}
+
+        self.peak_playing = 0
+        self.last_sample = (time.monotonic(), time.process_time())
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __iter__(self):
+        return iter(list(self.sessions.values()))
+
+    def get(self, server):
+        session = self.sessions.get(server.id)
+        if session is None:
+            session = self.sessions[server.id] = GuildSession(self.bot, server)
+            self.bot.log('Started a session for %s (%d total).' % (server.name, len(self.sessions)))
+        return session
+
+    def find(self, server):
+        return self.sessions.get(server.id)
+
+    def close(self, server):
+        session = self.sessions.pop(server.id, None)
+        if session is not None:
+            session.stop()
+
+    def close_all(self):
+        for session in self:
+            session.stop()
+        self.sessions.clear()
+
+    def playing(self):
+        return [session for session in self.sessions.values() if session.is_playing()]
+
+    def record_playing(self):
+        self.peak_playing = max(self.peak_playing, len(self.playing()))
+
+    def reset_pools(self):
+        # The catalog changed, so pools may hold episodes that are gone.
+        for session in self:
+            session.episode_pool = []
+
+    def stats(self):
+        # CPU time of the bot process per second of wall time since the last
+        # call, which includes encoding audio for every stream. Compare with
+        # the number playing to see how many sessions one core keeps up with.
+        now, cpu = time.monotonic(), time.process_time()
+        last_now, last_cpu = self.last_sample
+        self.last_sample = (now, cpu)
+
+        return {'sessions': len(self.sessions), 'playing': len(self.playing()), 'peak_playing': self.peak_playing,
+                'queued': sum(len(session.queue) for session in self.sessions.values()),
+                'cpu': (cpu - last_cpu) / (now - last_now) if now > last_now else 0.0}
@@ -1,6 +1,11 @@
+import asyncio
+import functools
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import pymongo
+from pymongo.errors import DuplicateKeyError
 from discord.user import User
 
 
@@ -8,7 +13,7 @@ def get_user_id(user):
     if isinstance(user, User) or issubclass(user.__class__, User):
         return user.id
     elif isinstance(user, SpongebotUser):
-        return user.as_document()['_id']
+        return user._id
     else:
         return user
 
@@ -25,38 +30,351 @@ class UserMongoDB:
 
         self.mongodb = self.mongo['spongebot']
         self.userdb = self.mongodb['users']
+        self.itemdb = self.mongodb['inventory']
 
-    def insert(self, user):
-        user_id = get_user_id(user)
+        self.executor = None
+        self.initialized = False
+        self.initialize_lock = asyncio.Lock(loop=bot.loop)
+
+        # user_id -> (expiry, SpongebotUser), least recently used first.
+        self.cache = OrderedDict()
+        self.cache_generation = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def run(self, func, *args, **kwargs):
+        # pymongo is blocking, so every round trip is pushed onto a bounded
+        # thread pool to keep the event loop free.
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.bot.config.get('mongodb_workers', 4))
+
+        return self.bot.loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def initialize(self):
+        # Only marked done once everything succeeded, so a failed attempt is
+        # retried on the next on_ready. The lock keeps a reconnect from
+        # migrating alongside an attempt that is still running.
+        async with self.initialize_lock:
+            if self.initialized:
+                return
+
+            await self.run(self.itemdb.create_index, [('user_id', pymongo.ASCENDING),
+                                                      ('item_type', pymongo.ASCENDING),
+                                                      ('name', pymongo.ASCENDING)], unique=True)
+            # Leaderboard sorts and rank counts.
+            for field in ('total_points', 'crates_opened', 'episodes_watched'):
+                await self.run(self.userdb.create_index, [(field, pymongo.DESCENDING)])
+            migrated = await self.run(self.migrate_inventory)
+            if migrated:
+                self.bot.log('Migrated embedded inventories of %d user(s).' % migrated)
+
+            self.initialized = True
+
+    def migrate_inventory(self):
+        # Moves the inventory lists that used to be embedded in user documents
+        # into the inventory collection. Safe to run again if interrupted.
+        migrated = 0
+        for document in self.userdb.find({'inventory': {'$exists': True}}, {'inventory': True}):
+            for item in document['inventory']:
+                item['user_id'] = document['_id']
+                try:
+                    self.itemdb.insert_one(item)
+                except DuplicateKeyError:
+                    spec = {'user_id': document['_id'], 'item_type': item['item_type'], 'idx': item['idx']}
+                    if self.itemdb.find_one(spec) is not None:
+                        continue
+                    # A name clash in the old list; keep the item under its index like undo does.
+                    item.pop('_id', None)
+                    item['name'] = str(item['idx'])
+                    self.itemdb.insert_one(item)
+
+            self.userdb.update_one({'_id': document['_id']}, {'$unset': {'inventory': ''}})
+            migrated += 1
+
+        return migrated
+
+    def new_document(self, user):
         spongebot_user = SpongebotUser()
-        spongebot_user._id = user_id
-        spongebot_user.name = user.name
+        spongebot_user._id = get_user_id(user)
+        spongebot_user.name = getattr(user, 'name', '')
         spongebot_user.create_date = int(time.time())
-        self.userdb.insert_one(spongebot_user.as_document())
+        document = spongebot_user.as_document()
+        # Items live in their own collection.
+        del document['inventory']
+        return document
 
-    def get(self, user):
+    async def insert(self, user):
+        self.cache_invalidate(get_user_id(user))
+        await self.run(self.userdb.insert_one, self.new_document(user))
+
+    async def get(self, user, fields=None):
+        # With a list of fields, only those are fetched and the returned user
+        # is partially loaded; touching anything else raises UnloadedFieldError.
         user_id = get_user_id(user)
 
-        document = self.userdb.find_one({'_id': user_id})
+        spongebot_user = self.cache_get(user_id, fields)
+        if spongebot_user is not None:
+            return spongebot_user
+
+        projection = None
+        if fields is not None:
+            projection = {field: True for field in fields}
+
+        with_inventory = fields is None or 'inventory' in fields
+
+        generation = self.cache_generation
+        document = await self.run(self.find_user, user_id, projection, with_inventory)
         if document is None:
             return None
 
-        spongebot_user = SpongebotUser()
-        spongebot_user.from_document(document)
+        spongebot_user = SpongebotUser.from_document(document, partial=fields is not None)
+
+        # Don't cache a document that a write may have overtaken in flight.
+        # Item writes don't go through the user cache, so a user read with
+        # their inventory is returned but not cached.
+        if generation == self.cache_generation and not with_inventory:
+            spongebot_user = self.cache_put(user_id, spongebot_user)
 
         return spongebot_user
 
-    def update(self, user, new):
+    def find_user(self, user_id, projection, with_inventory):
+        document = self.userdb.find_one({'_id': user_id}, projection)
+        if document is not None and with_inventory:
+            document['inventory'] = list(self.itemdb.find({'user_id': user_id}))
+        return document
+
+    async def bootstrap(self, user):
+        # Creates the user if needed and returns their access level in a
+        # single round trip.
+        user_id = get_user_id(user)
+
+        spongebot_user = self.cache_get(user_id, ('access_level',))
+        if spongebot_user is not None:
+            return spongebot_user.access_level
+
+        generation = self.cache_generation
+        document = await self.run(self.userdb.find_one_and_update, {'_id': user_id}, self.with_defaults(user, {}),
+                                  projection={'access_level': True}, upsert=True,
+                                  return_document=pymongo.ReturnDocument.AFTER)
+
+        spongebot_user = SpongebotUser.from_document(document, partial=True)
+
+        if generation == self.cache_generation:
+            self.cache_put(user_id, spongebot_user)
+
+        return spongebot_user.access_level
+
+    async def update(self, user, new):
+        user_id = get_user_id(user)
+        self.cache_patch(user_id, new)
+        try:
+            await self.run(self.userdb.update_one, {'_id': user_id}, new)
+        except Exception:
+            self.cache_invalidate(user_id)
+            raise
+
+    async def charge(self, user, price, increments, fields):
+        # Takes price points and applies increments in one atomic update, but
+        # only if the user has the points. Returns the user with fields as
+        # they are after the update, or None if they couldn't afford it.
+        user_id = get_user_id(user)
+
+        update = {'$inc': dict(increments)}
+        update['$inc']['current_points'] = update['$inc'].get('current_points', 0) - price
+
+        # Dropped before the round trip so a read already in flight won't be
+        # cached, and again after so one that started during it is dropped.
+        # Patching instead could apply $inc to an already charged copy.
+        self.cache_invalidate(user_id)
+        try:
+            document = await self.run(self.userdb.find_one_and_update,
+                                      {'_id': user_id, 'current_points': {'$gte': price}}, update,
+                                      projection={field: True for field in fields},
+                                      return_document=pymongo.ReturnDocument.AFTER)
+        finally:
+            self.cache_invalidate(user_id)
+
+        if document is None:
+            return None
+
+        return SpongebotUser.from_document(document, partial=True)
+
+    async def bulk_upsert(self, users, new):
+        # One round trip for the whole batch, however many users it covers.
+        requests = []
+        for user in users:
+            user_id = get_user_id(user)
+            self.cache_patch(user_id, new)
+            requests.append(pymongo.UpdateOne({'_id': user_id}, self.with_defaults(user, new), upsert=True))
+
+        if not requests:
+            return None
+
+        try:
+            return await self.run(self.userdb.bulk_write, requests, ordered=False)
+        except Exception:
+            for user in users:
+                self.cache_invalidate(get_user_id(user))
+            raise
+
+    async def top_users(self, field, limit, user_ids=None, above=None):
+        # (user_id, name, value) of the highest values of field, optionally
+        # only among user_ids and only above a value.
+        spec = {}
+        if user_ids is not None:
+            spec['_id'] = {'$in': list(user_ids)}
+        if above is not None:
+            spec[field] = {'$gt': above}
+
+        def query():
+            cursor = self.userdb.find(spec, {'name': True, field: True}).sort(field, pymongo.DESCENDING).limit(limit)
+            return [(document['_id'], document.get('name', ''), document.get(field, 0)) for document in cursor]
+
+        return await self.run(query)
+
+    async def rank(self, field, value):
+        # 1-based position of value among all users, ties sharing a rank.
+        return await self.run(self.userdb.count, {field: {'$gt': value}}) + 1
+
+    async def add_item(self, user, item):
         user_id = get_user_id(user)
-        self.userdb.update_one({'_id': user_id}, new)
+        document = item.as_document()
+        document['user_id'] = user_id
 
-    def exists(self, user):
+        await self.run(self.itemdb.insert_one, document)
+
+    async def get_item(self, user, item_type, name):
         user_id = get_user_id(user)
 
-        return self.userdb.find_one({'_id': user_id}) is not None
+        document = await self.run(self.itemdb.find_one, {'user_id': user_id, 'item_type': item_type, 'name': name})
+        if document is None:
+            return None
+
+        return item_from_document(document)
+
+    async def remove_item(self, user, item_type, name):
+        # Returns the removed item, or None if the user doesn't own it.
+        user_id = get_user_id(user)
+
+        document = await self.run(self.itemdb.find_one_and_delete,
+                                  {'user_id': user_id, 'item_type': item_type, 'name': name})
+        if document is None:
+            return None
+
+        return item_from_document(document)
+
+    async def rename_item(self, user, item_type, from_name, to_name):
+        # Returns False if the user already has an item of that type named to_name.
+        user_id = get_user_id(user)
+
+        try:
+            await self.run(self.itemdb.update_one, {'user_id': user_id, 'item_type': item_type, 'name': from_name},
+                           {'$set': {'name': to_name}})
+        except DuplicateKeyError:
+            return False
+
+        return True
+
+    async def list_items(self, user, item_type=None, page=0, per_page=25):
+        # Returns one page of items ordered by index, plus the total count.
+        user_id = get_user_id(user)
+
+        spec = {'user_id': user_id}
+        if item_type is not None:
+            spec['item_type'] = item_type
+
+        def query():
+            cursor = self.itemdb.find(spec).sort('idx', pymongo.ASCENDING).skip(page * per_page).limit(per_page)
+            return [item_from_document(document) for document in cursor], self.itemdb.count(spec)
+
+        return await self.run(query)
+
+    def cache_get(self, user_id, fields=None):
+        entry = self.cache.get(user_id)
+        if entry is not None and entry[0] < time.monotonic():
+            del self.cache[user_id]
+            entry = None
+
+        if entry is None or not entry[1].is_loaded(*(fields or SpongebotUser.FIELDS)):
+            self.cache_misses += 1
+            return None
+
+        self.cache.move_to_end(user_id)
+        self.cache_hits += 1
+        return entry[1]
+
+    def cache_put(self, user_id, spongebot_user):
+        # Partial reads of the same user are merged into one cached object.
+        entry = self.cache.get(user_id)
+        if entry is not None and entry[0] >= time.monotonic():
+            entry[1].merge(spongebot_user)
+            self.cache.move_to_end(user_id)
+            return entry[1]
+
+        expiry = time.monotonic() + self.bot.config.get('user_cache_ttl', 300)
+        self.cache[user_id] = (expiry, spongebot_user)
+        self.cache.move_to_end(user_id)
+
+        while len(self.cache) > self.bot.config.get('user_cache_size', 1024):
+            self.cache.popitem(last=False)
+
+        return spongebot_user
+
+    def cache_patch(self, user_id, new):
+        # Plain counter increments are applied to the cached copy in place;
+        # anything else just drops the entry so the next read refetches it.
+        self.cache_generation += 1
+
+        entry = self.cache.get(user_id)
+        if entry is None:
+            return
+
+        spongebot_user = entry[1]
+        increments = new.get('$inc', {})
+        if len(new) != 1 or not increments or any('.' in field for field in increments):
+            self.cache_invalidate(user_id)
+            return
+
+        for field, amount in increments.items():
+            # Fields that were never loaded will be fetched fresh anyway.
+            if spongebot_user.is_loaded(field):
+                setattr(spongebot_user, field, getattr(spongebot_user, field) + amount)
+
+    def cache_invalidate(self, user_id):
+        self.cache_generation += 1
+        self.cache.pop(user_id, None)
+
+    def cache_info(self):
+        return {'hits': self.cache_hits, 'misses': self.cache_misses, 'size': len(self.cache)}
+
+    def with_defaults(self, user, new):
+        # Fill in the rest of a fresh user document on insert, skipping any
+        # field the update already touches (Mongo rejects the conflict).
+        touched = set()
+        for fields in new.values():
+            touched.update(field.split('.', 1)[0] for field in fields)
+
+        defaults = {key: value for key, value in self.new_document(user).items()
+                    if key not in touched and key != '_id'}
+
+        new = dict(new)
+        new['$setOnInsert'] = defaults
+        return new
+
+
+class UnloadedFieldError(AttributeError):
+    pass
 
 
 class SpongebotUser:
+    FIELDS = ('_id', 'name', 'create_date', 'access_level', 'current_points', 'total_points', 'crates_opened',
+              'frame_id', 'voiceline_id', 'episodes_watched', 'episode_list', 'inventory', 'last_sold_item')
+    # Fields stored as-is in the document.
+    PLAIN_FIELDS = FIELDS[:-2]
+
+    # An unset slot is a field that a projected read did not load.
+    __slots__ = FIELDS
+
     def __init__(self):
         self._id = 0
         self.name = ''
@@ -69,68 +387,173 @@ class SpongebotUser:
         self.voiceline_id = 0
         self.episodes_watched = 0
         self.episode_list = []
-        self.inventory = []
+        self.inventory = Inventory()
         self.last_sold_item = None
 
+    def __getattr__(self, name):
+        # Only reached when normal lookup fails, i.e. for fields a projected
+        # read left out.
+        if name in SpongebotUser.FIELDS:
+            user_id = None
+            if name != '_id':
+                user_id = getattr(self, '_id', None)
+            raise UnloadedFieldError('Field %s is not loaded for user %s.' % (name, user_id))
+        raise AttributeError(name)
+
+    def is_loaded(self, *fields):
+        return all(hasattr(self, field) for field in fields)
+
+    def merge(self, other):
+        for field in SpongebotUser.FIELDS:
+            if other.is_loaded(field):
+                setattr(self, field, getattr(other, field))
+
     def as_document(self):
-        documented_inv = [item.as_document() for item in self.inventory]
-        documented_lsi = self.last_sold_item
-        if self.last_sold_item is not None:
-            documented_lsi = self.last_sold_item.as_document()
-        document = self.__dict__.copy()
-        document['inventory'] = documented_inv
-        document['last_sold_item'] = documented_lsi
+        document = {}
+        for field in SpongebotUser.PLAIN_FIELDS:
+            if hasattr(self, field):
+                document[field] = getattr(self, field)
+        if hasattr(self, 'inventory'):
+            document['inventory'] = [item.as_document() for item in self.inventory]
+        if hasattr(self, 'last_sold_item'):
+            document['last_sold_item'] = None
+            if self.last_sold_item is not None:
+                document['last_sold_item'] = self.last_sold_item.as_document()
         return document
 
-    def from_document(self, document):
-        undocumented_inventory = []
-        for doc in document['inventory']:
-            if doc['item_type'] == 'frame':
-                item = FrameInventoryItem(0, 0, 0, 0, 0)
-            elif doc['item_type'] == 'voiceline':
-                item = VoicelineInventoryItem(0, 0, 0, 0, 0)
-            else:
+    @classmethod
+    def from_document(cls, document, partial=False):
+        # A full read starts from the defaults so older documents missing a
+        # field still load; a partial one only gets what the document has.
+        if partial:
+            spongebot_user = cls.__new__(cls)
+        else:
+            spongebot_user = cls()
+
+        for field in cls.PLAIN_FIELDS:
+            if field in document:
+                setattr(spongebot_user, field, document[field])
+        if 'inventory' in document:
+            spongebot_user.inventory = Inventory.from_documents(document['inventory'])
+        if 'last_sold_item' in document:
+            spongebot_user.last_sold_item = None
+            if document['last_sold_item']:
+                spongebot_user.last_sold_item = item_from_document(document['last_sold_item'])
+
+        return spongebot_user
+
+
+class Inventory:
+    # Items grouped by type, then name, as loaded by a full get(). Commands
+    # look items up through the indexed inventory collection instead.
+    __slots__ = ('by_type',)
+
+    def __init__(self):
+        self.by_type = {}
+
+    @classmethod
+    def from_documents(cls, documents):
+        inventory = cls()
+        by_type = inventory.by_type
+        for document in documents:
+            item_cls = ITEM_TYPES.get(document['item_type'])
+            if item_cls is None:
                 continue
-            item.from_document(doc)
-            undocumented_inventory.append(item)
-        undocumented_lsi = None
-        if document.get('last_sold_item'):
-            item = None
-            if document['last_sold_item']['item_type'] == 'frame':
-                item = FrameInventoryItem(0, 0, 0, 0, 0)
-            elif document['last_sold_item']['item_type'] == 'voiceline':
-                item = VoicelineInventoryItem(0, 0, 0, 0, 0)
-            if item is not None:
-                item.from_document(document['last_sold_item'])
-                undocumented_lsi = item
-        document['inventory'] = undocumented_inventory
-        document['last_sold_item'] = undocumented_lsi
-        self.__dict__.update(document)
+            items = by_type.get(item_cls.ITEM_TYPE)
+            if items is None:
+                items = by_type[item_cls.ITEM_TYPE] = OrderedDict()
+            item = item_cls.from_document(document)
+            items[item.name] = item
+        return inventory
+
+    def __len__(self):
+        return sum(len(items) for items in self.by_type.values())
+
+    def __iter__(self):
+        for items in self.by_type.values():
+            yield from items.values()
+
+
+# item_type -> InventoryItem subclass
+ITEM_TYPES = {}
+
+
+def register_item_type(name):
+    def register(cls):
+        cls.ITEM_TYPE = name
+        ITEM_TYPES[name] = cls
+        return cls
+    return register
 
 
 class InventoryItem:
+    FIELDS = ('item_type', 'date_received')
+
+    __slots__ = FIELDS
+
     def __init__(self, item_type, date_received):
         self.item_type = item_type
         self.date_received = date_received
 
     def as_document(self):
-        return self.__dict__
+        return {field: getattr(self, field) for field in self.FIELDS}
 
-    def from_document(self, document):
-        self.__dict__.update(document)
+    @classmethod
+    def from_document(cls, document):
+        # Skips __init__; the inventory collection's own _id and user_id
+        # fields are simply not copied.
+        item = cls.__new__(cls)
+        for field in cls.FIELDS:
+            setattr(item, field, document.get(field))
+        return item
 
 
-class FrameInventoryItem(InventoryItem):
-    def __init__(self, item_type, date_received, name, idx, from_episode):
-        InventoryItem.__init__(self, item_type, date_received)
-        self.name = name
-        self.idx = idx
-        self.from_episode = from_episode
+class CrateInventoryItem(InventoryItem):
+    # Anything that comes out of a crate.
+    FIELDS = InventoryItem.FIELDS + ('name', 'idx', 'from_episode')
 
+    __slots__ = FIELDS[len(InventoryItem.FIELDS):]
 
-class VoicelineInventoryItem(InventoryItem):
     def __init__(self, item_type, date_received, name, idx, from_episode):
         InventoryItem.__init__(self, item_type, date_received)
         self.name = name
         self.idx = idx
         self.from_episode = from_episode
+
+    # Spelled out instead of looping over FIELDS: items are decoded by the
+    # thousand and this is about twice as fast.
+    def as_document(self):
+        return {
+            'item_type': self.item_type,
+            'date_received': self.date_received,
+            'name': self.name,
+            'idx': self.idx,
+            'from_episode': self.from_episode,
+        }
+
+    @classmethod
+    def from_document(cls, document):
+        item = cls.__new__(cls)
+        item.item_type = document['item_type']
+        item.date_received = document.get('date_received')
+        item.name = document.get('name')
+        item.idx = document.get('idx')
+        item.from_episode = document.get('from_episode')
+        return item
+
+
+@register_item_type('frame')
+class FrameInventoryItem(CrateInventoryItem):
+    __slots__ = ()
+
+
+@register_item_type('voiceline')
+class VoicelineInventoryItem(CrateInventoryItem):
+    __slots__ = ()
+
+
+def item_from_document(document):
+    cls = ITEM_TYPES.get(document['item_type'])
+    if cls is None:
+        return None
+    return cls.from_document(document)